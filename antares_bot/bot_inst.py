@@ -7,7 +7,7 @@ import sys
 import time
 import traceback
 from logging import DEBUG as LOGLEVEL_DEBUG
-from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union, cast
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, Type, TypeVar, Union, cast
 
 from telegram import MessageOriginChannel, MessageOriginChat, MessageOriginUser, Update
 from telegram.error import Conflict, NetworkError, RetryAfter, TimedOut
@@ -17,21 +17,26 @@ from antares_bot.basic_language import BasicLanguage as Lang
 from antares_bot.bot_base import TelegramBotBase
 from antares_bot.bot_default_cfg import AntaresBotConfig, BasicConfig
 from antares_bot.bot_logging import get_logger, get_root_logger, stop_logger
-from antares_bot.callback_manager import CallbackDataManager
+from antares_bot.callback_manager import CALLBACK_DATA_DEFAULT_TTL, CallbackDataManager, CallbackKeyIndex
+from antares_bot.callback_payload import SignedCallbackCodec
 from antares_bot.context import ChatData, RichCallbackContext, UserData
 from antares_bot.context_manager import ContextHelper, ContextReverseHelper, get_context
 from antares_bot.error import InvalidChatTypeException, UserPermissionException, permission_exceptions
 from antares_bot.framework import CallbackBase, command_callback_wrapper
 from antares_bot.module_loader import ModuleKeeper
+from antares_bot.patching.dispatch_handler import add_handler
 from antares_bot.patching.job_quque_ex import JobQueueEx
+from antares_bot.patching.update_processor_ex import ChatLaneUpdateProcessor
+from antares_bot.patching.update_queue_ex import BoundedUpdateQueue
 from antares_bot.permission_check import CheckLevel
+from antares_bot.sqlite.callback_store import CallbackDataStore
 from antares_bot.sqlite.manager import DataBasesManager
 from antares_bot.text_process import trim_spaces_before_line
 from antares_bot.utils import SYSTEM_TIME_ZONE, markdown_escape, read_user_cfg, systemd_service_info
 
 
 if TYPE_CHECKING:
-    from telegram.ext import ExtBot
+    from telegram.ext import BaseHandler, ExtBot
 
     from antares_bot.module_base import TelegramBotModuleBase
 
@@ -39,6 +44,13 @@ _T = TypeVar("_T", bound="TelegramBotModuleBase", covariant=True)
 
 _LOGGER = get_logger("main")
 TIME_IN_A_DAY = 24 * 60 * 60
+WEBHOOK_DEFAULT_WORKERS = 32
+WEBHOOK_DEFAULT_QUEUE_SIZE = 1024
+CHAT_LANE_DEFAULT_MAX_CONCURRENT = 256
+CALLBACK_DATA_DEFAULT_SWEEP_INTERVAL = 60
+CALLBACK_DATA_DEFAULT_MEMORY_SIZE = 10000
+CALLBACK_DATA_STORE_FILE = "callback_data.db"
+CALLBACK_KEY_INDEX_DEFAULT_MAX_SIZE = 65536
 
 _PROGRAM_SHUTDOWN_STARTED = False
 
@@ -107,8 +119,7 @@ class TelegramBot(TelegramBotBase):
             user_data=self.UserDataType,
             bot_data=self.BotDataType  # type: ignore
         )
-        self.application = cast(
-            "Application[ExtBot[None], self.ContextType, self.UserDataType, self.ChatDataType, self.BotDataType, JobQueueEx]",
+        builder = (
             Application.builder()
             # .application_class(ApplicationEx)
             .token(read_user_cfg(BasicConfig, "TOKEN"))
@@ -116,7 +127,26 @@ class TelegramBot(TelegramBotBase):
             .job_queue(JobQueueEx())
             .post_init(self._do_post_init)
             .post_stop(self._do_post_stop)
-            .build()
+        )
+        self._webhook_config: dict[str, Any] | None = read_user_cfg(AntaresBotConfig, "WEBHOOK_CONFIG")
+        if self._webhook_config is not None:
+            # bounded intake: updates are only taken off the queue when a worker is free,
+            # and the webhook server waits (and so does Telegram) when the queue is full
+            queue_size = self._webhook_config.get("queue_size", WEBHOOK_DEFAULT_QUEUE_SIZE)
+            workers = self._webhook_config.get("workers", WEBHOOK_DEFAULT_WORKERS)
+            builder = builder.update_queue(BoundedUpdateQueue(maxsize=queue_size, max_in_flight=workers))
+            builder = builder.concurrent_updates(workers)
+        self._chat_lane_config: dict[str, Any] | None = read_user_cfg(AntaresBotConfig, "CHAT_LANE_CONFIG")
+        if self._chat_lane_config is not None:
+            if self._webhook_config is not None:
+                default_max_concurrent = self._webhook_config.get("workers", WEBHOOK_DEFAULT_WORKERS)
+            else:
+                default_max_concurrent = CHAT_LANE_DEFAULT_MAX_CONCURRENT
+            max_concurrent = self._chat_lane_config.get("max_concurrent_updates", default_max_concurrent)
+            builder = builder.concurrent_updates(ChatLaneUpdateProcessor(max_concurrent))
+        self.application = cast(
+            "Application[ExtBot[None], self.ContextType, self.UserDataType, self.ChatDataType, self.BotDataType, JobQueueEx]",
+            builder.build()
         )
         self.bot = self.application.bot
         assert self.application.updater is not None
@@ -124,8 +154,30 @@ class TelegramBot(TelegramBotBase):
         assert self.application.job_queue is not None
         self.job_queue = self.application.job_queue
         #
-        self.callback_manager = CallbackDataManager()
-        self.callback_key_dict: Dict[Tuple[int, int], List[str]] = dict()
+        self._callback_data_config: dict[str, Any] = read_user_cfg(AntaresBotConfig, "CALLBACK_DATA_CONFIG") or {}
+        callback_data_store = None
+        callback_data_max_size = self._callback_data_config.get("max_size")
+        if self._callback_data_config.get("persist"):
+            callback_data_store = CallbackDataStore(os.path.join(self.data_dir(), CALLBACK_DATA_STORE_FILE))
+            if callback_data_max_size is None:
+                callback_data_max_size = CALLBACK_DATA_DEFAULT_MEMORY_SIZE
+        self.callback_manager = CallbackDataManager(
+            max_size=callback_data_max_size,
+            ttl=self._callback_data_config.get("ttl", CALLBACK_DATA_DEFAULT_TTL),
+            store=callback_data_store,
+        )
+        signing_key = self._callback_data_config.get("signing_key")
+        self.callback_codec = (
+            SignedCallbackCodec(signing_key.encode("utf-8")) if signing_key
+            else SignedCallbackCodec.from_token(read_user_cfg(BasicConfig, "TOKEN"))
+        )
+        self.callback_key_dict = CallbackKeyIndex(
+            self.callback_manager,
+            max_size=self._callback_data_config.get("max_messages", CALLBACK_KEY_INDEX_DEFAULT_MAX_SIZE),
+        )
+        sqlite_shared_workers: int | None = read_user_cfg(AntaresBotConfig, "SQLITE_SHARED_WORKERS")
+        if sqlite_shared_workers:
+            DataBasesManager.get_inst().enable_shared_workers(sqlite_shared_workers)
         self._old_log_level = None
         self._custom_post_init_task: Awaitable | None = None
         self._custom_post_stop_task: Awaitable | None = None
@@ -136,6 +188,8 @@ class TelegramBot(TelegramBotBase):
         self._custom_finalize_task: Callable[[], Any] | None = None
         self._normal_exit_flag = False
         self.handler_docs: dict[str, str] = {}
+        self._index_commands = not read_user_cfg(AntaresBotConfig, "SKIP_COMMAND_DISPATCH_INDEX")
+        self._index_callback_queries = not read_user_cfg(AntaresBotConfig, "SKIP_CALLBACK_QUERY_DISPATCH_INDEX")
         self._exit_fast = False
         # some pre-checks
         if self._is_debug_level():
@@ -169,6 +223,7 @@ class TelegramBot(TelegramBotBase):
         time1 = time.time()
         _LOGGER.warning("Post stop time: %.3fs", time1 - time0)
         task_stop_db = DataBasesManager.get_inst().shutdown()
+        self.callback_manager.close()
         time2 = time.time()
         _LOGGER.warning("Shutdown db time: %.3fs", time2 - time1)
         # pull the repo if _post_stop_gitpull_flag is set.
@@ -213,6 +268,7 @@ class TelegramBot(TelegramBotBase):
                     handler = func.to_handler()
                 else:
                     handler = func
+                self._fix_handler_block(handler)
                 if isinstance(handler, CommandHandler):
                     for command in handler.commands:
                         _doc = func.__doc__
@@ -224,7 +280,7 @@ class TelegramBot(TelegramBotBase):
                             for command in entry_point.commands:
                                 _doc = entry_point.callback.__doc__
                                 self.handler_docs[command] = _doc if _doc else "No doc"
-                self.application.add_handler(handler)
+                self._add_handler(handler)
                 # try get module logger
                 py_module = module.py_module()
                 if hasattr(py_module, "_LOGGER"):
@@ -245,7 +301,8 @@ class TelegramBot(TelegramBotBase):
 
         for method in main_handlers:
             handler = method.to_handler()  # pylint: disable=no-member
-            self.application.add_handler(handler)
+            self._fix_handler_block(handler)
+            self._add_handler(handler)
             for command in handler.commands:
                 self.handler_docs[command] = method.__doc__ if method.__doc__ else "No doc"
             _LOGGER.info("added handler: %s", handler)
@@ -258,6 +315,8 @@ class TelegramBot(TelegramBotBase):
         self.application.add_error_handler(exception_handler)
 
         self.job_queue.run_daily(self._daily_job, time=datetime.time(hour=0, minute=0, tzinfo=SYSTEM_TIME_ZONE), name="daily_job")
+        sweep_interval = self._callback_data_config.get("sweep_interval", CALLBACK_DATA_DEFAULT_SWEEP_INTERVAL)
+        self.job_queue.run_repeating(self._callback_data_sweep_job, interval=sweep_interval, name="callback_data_sweep")
 
         signal.signal(signal.SIGINT, self.signal_stop)
         signal.signal(signal.SIGTERM, self.signal_stop)
@@ -268,11 +327,14 @@ class TelegramBot(TelegramBotBase):
             asyncio.get_event_loop().set_task_factory(asyncio.eager_task_factory)
 
         try:
-            self.application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,
-                stop_signals=(),
-            )
+            if self._webhook_config is not None:
+                self._run_webhook(self._webhook_config)
+            else:
+                self.application.run_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,
+                    stop_signals=(),
+                )
         except NetworkError:
             # catches the NetworkError when the bot is turned off.
             # we don't care about that when normal exit
@@ -282,6 +344,63 @@ class TelegramBot(TelegramBotBase):
         # post run
         self._post_run()
 
+    def _add_handler(self, handler: "BaseHandler"):
+        """
+        Plain command handlers and callback query handlers go to dispatch indexes, see `dispatch_handler.add_handler`.
+        """
+        add_handler(self.application, handler, self._index_commands, self._index_callback_queries)
+
+    def _fix_handler_block(self, handler: "BaseHandler"):
+        """
+        In chat lane mode, handlers must run blocking, otherwise the order of updates in a chat is lost.
+        Conversation handlers are always blocking and deal with non-blocking callbacks themselves.
+        """
+        if self._chat_lane_config is not None and not isinstance(handler, ConversationHandler):
+            handler.block = True
+
+    def chat_lane_queue_depths(self) -> dict[str, Any] | None:
+        """
+        Return the queue depths of chat lanes, or `None` if chat lane mode is not enabled.
+        """
+        processor = self.application.update_processor
+        if isinstance(processor, ChatLaneUpdateProcessor):
+            return processor.queue_depths()
+        return None
+
+    def _run_webhook(self, webhook_config: dict[str, Any]):
+        """
+        Receive updates by a local HTTP listener instead of long polling.
+        Pending updates are kept by default, so no update is lost on restart.
+        If `webhook_url` is not set, the listener address is registered,
+        which is only useful behind a reverse proxy or for a local stand-in server.
+        """
+        _LOGGER.warning(
+            "Running in webhook mode on %s:%s, workers: %s, queue size: %s",
+            webhook_config.get("listen", "127.0.0.1"),
+            webhook_config.get("port", 80),
+            self.application.concurrent_updates,
+            self.application.update_queue.maxsize,
+        )
+        self.application.run_webhook(
+            listen=webhook_config.get("listen", "127.0.0.1"),
+            port=webhook_config.get("port", 80),
+            url_path=webhook_config.get("url_path", ""),
+            cert=webhook_config.get("cert"),
+            key=webhook_config.get("key"),
+            webhook_url=webhook_config.get("webhook_url"),
+            secret_token=webhook_config.get("secret_token"),
+            max_connections=webhook_config.get("max_connections", 40),
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=webhook_config.get("drop_pending_updates", False),
+            stop_signals=(),
+        )
+
+    def webhook_queue_depth(self) -> int:
+        """
+        Number of received updates waiting for a free worker.
+        """
+        return self.application.update_queue.qsize()
+
     def _post_run(self):
         global _PROGRAM_SHUTDOWN_STARTED
         if self._custom_finalize_task is not None:
@@ -416,16 +535,20 @@ class TelegramBot(TelegramBotBase):
     def data_dir(cls):
         return os.path.join(os.path.curdir, read_user_cfg(BasicConfig, "DATA_DIR"))
 
+    async def _callback_data_sweep_job(self, context: RichCallbackContext):
+        released = self.callback_key_dict.sweep()
+        if released and self._is_debug_level():
+            _LOGGER.debug("Sweep job: released %d messages from callback key index", released)
+        removed = self.callback_manager.sweep()
+        if removed and self._is_debug_level():
+            _LOGGER.debug("Sweep job: removed %s keys from callback manager", removed)
+
     async def _daily_job(self, context: RichCallbackContext):
-        is_debug = self._is_debug_level()
-        if is_debug:
-            _debug_ids = []
-        for old_id in self.callback_manager.history.pop_before_keys(time.time() - TIME_IN_A_DAY):
-            self.callback_manager.pop_data(old_id)
-            if is_debug:
-                _debug_ids.append(old_id)
-        if is_debug:
-            _LOGGER.debug("Daily job: removed %s keys from callback manager", _debug_ids)
+        _LOGGER.warning("Callback manager stats: %s", self.callback_manager.stats())
+        _LOGGER.warning("Callback key index stats: %s", self.callback_key_dict.stats())
+        worker_stats = DataBasesManager.get_inst().worker_stats()
+        if worker_stats is not None:
+            _LOGGER.warning("Sqlite worker stats: %s", worker_stats)
         #
         _LOGGER.warning("Start running daily jobs for each module")
         with ContextReverseHelper():
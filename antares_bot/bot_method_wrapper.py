@@ -1,9 +1,10 @@
 import asyncio
-from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, List, TypeVar
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, List, Optional, TypeVar
 
 from telegram.error import BadRequest, ChatMigrated, Forbidden, InvalidToken, RetryAfter, TelegramError
 
 from antares_bot.bot_logging import get_logger
+from antares_bot.rate_limiter import SendRateLimiter
 from antares_bot.text_process import longtext_split
 
 
@@ -69,7 +70,7 @@ class TelegramBotBaseWrapper(object):
             texts = longtext_split(text)
         if 'reply_to_message_id' not in kwargs:
             kwargs['reply_to_message_id'] = message.id
-        async for m in cls._sequence_send(message.reply_text, texts, **kwargs):
+        async for m in cls._sequence_send(message.reply_text, texts, _chat_id=message.chat_id, **kwargs):
             yield m
 
     ##############################
@@ -180,10 +181,12 @@ class TelegramBotBaseWrapper(object):
             yield await cls._send_ignore_parsemode_or_replyto_exceptions(interface_func, text=t, **kwargs)
 
     @classmethod
-    async def _retry_call(cls, func: Callable[..., Awaitable[_T]], *args, **kwargs):
+    async def _retry_call(cls, func: Callable[..., Awaitable[_T]], *args, _chat_id: Optional[int] = None, **kwargs):
         # not using `raise from` to avoid long traceback
+        limiter = SendRateLimiter.get_inst()
         for i in range(cls.RETRY_TIMES):
             try:
+                await limiter.acquire(_chat_id)
                 return await func(*args, **kwargs)
             except (BadRequest, ChatMigrated, Forbidden, InvalidToken) as e:
                 raise e  # exit fast
@@ -194,8 +197,11 @@ class TelegramBotBaseWrapper(object):
                     _LOGGER.warning("retrying %s %d/%d due to %s", func.__name__, i + 1, cls.RETRY_TIMES, str(e))
                 except Exception:
                     pass
-                _sleep_time = e.retry_after + 1 if isinstance(e, RetryAfter) else cls.RETRY_SLEEP_TIME
-                await asyncio.sleep(_sleep_time)
+                if isinstance(e, RetryAfter):
+                    # pause the whole lane; the next `acquire` waits for it
+                    limiter.block(_chat_id, e.retry_after + 1)
+                else:
+                    await asyncio.sleep(cls.RETRY_SLEEP_TIME)
         raise RuntimeError(f"unreachable: RETRY_TIMES={cls.RETRY_TIMES}")
 
     @classmethod
@@ -203,23 +209,35 @@ class TelegramBotBaseWrapper(object):
         cls,
         interface_func: Callable[..., Awaitable["Message"]],
         _no_retry=False,
+        _chat_id: Optional[int] = None,
         **kwargs
     ) -> "Message":
+        """
+        `_chat_id` is the chat for rate limiting, only needed if `chat_id` is not in kwargs (e.g. `Message.reply_text`).
+        """
+        if _chat_id is None:
+            _chat_id = kwargs.get('chat_id')
         try:
             if _no_retry:
-                return await interface_func(**kwargs)
-            return await cls._retry_call(interface_func, **kwargs)
+                limiter = SendRateLimiter.get_inst()
+                await limiter.acquire(_chat_id)
+                try:
+                    return await interface_func(**kwargs)
+                except RetryAfter as e:
+                    limiter.block(_chat_id, e.retry_after + 1)
+                    raise
+            return await cls._retry_call(interface_func, _chat_id=_chat_id, **kwargs)
         except BadRequest as e:
             if str(e).find("reply") != -1:
                 _LOGGER.error("send message failed, retrying by popping reply_to_message_id")
                 if kwargs.pop('reply_to_message_id', None) is not None:
-                    return await cls._send_ignore_parsemode_or_replyto_exceptions(interface_func, _no_retry, **kwargs)
+                    return await cls._send_ignore_parsemode_or_replyto_exceptions(interface_func, _no_retry, _chat_id, **kwargs)
             if str(e).find('parse') != -1:
                 _LOGGER.error("send message failed, retrying by popping parse_mode")
                 parse_mode = kwargs.pop('parse_mode', None)
                 if parse_mode is None:
                     raise
-                ret = await cls._send_ignore_parsemode_or_replyto_exceptions(interface_func, _no_retry, **kwargs)
+                ret = await cls._send_ignore_parsemode_or_replyto_exceptions(interface_func, _no_retry, _chat_id, **kwargs)
                 # reset parse_mode for the next call
                 kwargs['parse_mode'] = parse_mode
                 return ret
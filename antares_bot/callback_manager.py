@@ -1,6 +1,11 @@
-import bisect
+import itertools
+import random
+import string
+import sys
 import time
-from typing import TYPE_CHECKING, Any, Callable, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar, Union
+from array import array
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar, Union, cast
 
 from telegram import InlineKeyboardButton
 
@@ -10,70 +15,482 @@ from antares_bot.utils import flatten_button
 if TYPE_CHECKING:
     from telegram import InlineKeyboardMarkup
 
+    from antares_bot.sqlite.callback_store import CallbackDataStore
+
 _DataType = TypeVar("_DataType")
 
+CALLBACK_DATA_DEFAULT_TTL = 24 * 60 * 60  # seconds
+# max number of expired entries removed by each `set_data`. the rest is left to `sweep`
+_SWEEP_STEP = 16
+# the history is compacted if it has this many more entries than live data
+_HISTORY_COMPACT_SLACK = 1024
+# separates the key of a single entry keyboard and the button index, like `00Ab.3`
+KEYBOARD_INDEX_SEP = "."
+# url safe base 64 digits of callback data keys. must not contain `:` or `KEYBOARD_INDEX_SEP`
+_KEY_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase + "-_"
+_KEY_DIGITS = {c: i for i, c in enumerate(_KEY_ALPHABET)}
+# number of leading digits holding the epoch of the manager
+_EPOCH_LEN = 2
+_EPOCH_COUNT = len(_KEY_ALPHABET) ** _EPOCH_LEN
+# ids reserved in the store at a time, see `CallbackDataManager.set_data`
+_ID_RESERVE_BLOCK = 1024
+# without a store, ids start at a random offset below this (4 digits), so that the ids of two runs
+# rarely overlap even if their epochs collide
+_ID_RANDOM_START = len(_KEY_ALPHABET) ** 4
+
+
+def encode_key(n: int, width: int = 1) -> str:
+    """
+    encode a non negative int into base 64 digits, left padded to `width`.
+    """
+    digits = []
+    while n or len(digits) < width:
+        n, r = divmod(n, 64)
+        digits.append(_KEY_ALPHABET[r])
+    return "".join(reversed(digits))
+
+
+def decode_key(s: str) -> Optional[int]:
+    """
+    decode base 64 digits into an int. return `None` if `s` is not valid.
+    """
+    if not s:
+        return None
+    n = 0
+    for c in s:
+        d = _KEY_DIGITS.get(c)
+        if d is None:
+            return None
+        n = n * 64 + d
+    return n
+
 
 class CallbackHistoryManager:
-    __slots__ = ("history_queue")
+    """
+    Time ordered queue of the keys stored in `CallbackDataManager`.
+    It may contain keys that have already been removed from the manager.
+
+    A ring buffer over two parallel arrays (times and keys), so each item
+    costs 16 bytes and popping costs only the number of popped items.
+    """
+    __slots__ = ("_times", "_keys", "_head", "_size")
+
+    _MIN_CAPACITY = 64
 
     def __init__(self) -> None:
-        self.history_queue: List[Tuple[float, int]] = []
+        self._times = array("d", bytes(8 * self._MIN_CAPACITY))
+        self._keys = array("q", bytes(8 * self._MIN_CAPACITY))
+        self._head = 0
+        self._size = 0
+
+    def _resize(self, capacity: int) -> None:
+        times, keys = self._ordered_arrays()
+        self._times = times + array("d", bytes(8 * (capacity - self._size)))
+        self._keys = keys + array("q", bytes(8 * (capacity - self._size)))
+        self._head = 0
+
+    def _ordered_arrays(self) -> Tuple[array, array]:
+        head, end = self._head, self._head + self._size
+        capacity = len(self._times)
+        if end <= capacity:
+            return self._times[head:end], self._keys[head:end]
+        end -= capacity
+        return self._times[head:] + self._times[:end], self._keys[head:] + self._keys[:end]
+
+    def _maybe_shrink(self) -> None:
+        capacity = len(self._times)
+        if capacity > self._MIN_CAPACITY and self._size < capacity // 4:
+            self._resize(max(capacity // 2, self._MIN_CAPACITY))
+
+    def enqueue(self, key: int, now: Optional[float] = None) -> None:
+        capacity = len(self._times)
+        if self._size == capacity:
+            self._resize(capacity * 2)
+            capacity *= 2
+        idx = (self._head + self._size) % capacity
+        self._times[idx] = time.time() if now is None else now
+        self._keys[idx] = key
+        self._size += 1
+
+    def _pop_front(self) -> int:
+        head = self._head
+        key = self._keys[head]
+        self._head = (head + 1) % len(self._times)
+        self._size -= 1
+        return key
+
+    def pop_before_keys(self, before: float, max_count: Optional[int] = None):
+        """
+        pop and yield the keys enqueued before `before`, at most `max_count` of them.
+        """
+        count = 0
+        while self._size > 0 and self._times[self._head] < before:
+            if max_count is not None and count >= max_count:
+                break
+            count += 1
+            yield self._pop_front()
+        self._maybe_shrink()
+
+    def pop_oldest(self) -> Optional[int]:
+        if self._size == 0:
+            return None
+        key = self._pop_front()
+        self._maybe_shrink()
+        return key
 
-    def enqueue(self, key: int) -> None:
-        self.history_queue.append((time.time(), key))
+    def retain(self, predicate: Callable[[int], bool]) -> None:
+        """
+        drop the keys which do not satisfy `predicate`.
+        """
+        times, keys = self._ordered_arrays()
+        kept = [i for i, k in enumerate(keys) if predicate(k)]
+        self._times = array("d", (times[i] for i in kept))
+        self._keys = array("q", (keys[i] for i in kept))
+        self._head = 0
+        self._size = len(kept)
+        self._resize(max(self._MIN_CAPACITY, self._size))
 
-    def pop_before_keys(self, before: float):
-        history_queue = self.history_queue
-        idx = bisect.bisect_left(history_queue, (before, 0))
-        if idx > 0:
-            self.history_queue = history_queue[idx:]
-        yield from (k for _, k in history_queue[:idx])
+    def memory_size(self) -> int:
+        return sys.getsizeof(self._times) + sys.getsizeof(self._keys)
 
+    def __len__(self) -> int:
+        return self._size
 
-class CallbackDataManager:
-    __slots__ = ("id", "_dict", "history")
 
-    def __init__(self) -> None:
-        self.id = 0
-        self._dict: Dict[int, Any] = {}
+class CallbackDataManager:
+    """
+    Store the callback data of buttons.
+    `max_size` caps the number of entries in memory. Above it, the oldest entries are evicted,
+    or with a `store`, the least recently used ones are spilled to disk. Keyboards are not spilled before `close`.
+    Entries older than `ttl` seconds expire. Expired entries are removed a few at a time
+    by `set_data`, and the rest by calling `sweep` periodically.
+
+    With a `store`, entries survive restarts as long as `close` is called on shutdown,
+    and the ttl of an entry restarts when it is loaded back from disk. Spilled entries keep
+    the time they were set or loaded, and the next id is reserved in the store ahead of use,
+    so ids are never handed out twice across restarts.
+
+    Keys are the epoch of the manager followed by the id, both in url safe base 64 (`encode_key`).
+    The epoch is drawn at random on start, or kept in the store, so keys of a previous run
+    are rejected by a prefix check without looking them up. Without a store, ids also start
+    at a random offset, so a stale key needs both the epoch and the id range to collide.
+    """
+    __slots__ = (
+        "id", "_dict", "history", "max_size", "ttl", "evicted_count", "expired_count", "_store", "_enqueued_at", "spilled_count", "loaded_count",
+        "epoch", "_epoch_tag", "stale_count", "_id_limit",
+    )
+
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = CALLBACK_DATA_DEFAULT_TTL,
+        store: Optional["CallbackDataStore"] = None,
+    ) -> None:
+        self.id = random.randrange(_ID_RANDOM_START) if store is None else 0
+        self._dict: Dict[int, Any] = {} if store is None else OrderedDict()
         self.history = CallbackHistoryManager()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evicted_count = 0
+        self.expired_count = 0
+        self._store = store
+        # with a store, the time each entry was set or loaded back from disk.
+        # older history items of loaded entries must be ignored, and spills keep this time
+        self._enqueued_at: Dict[int, float] = {}
+        self.spilled_count = 0
+        self.loaded_count = 0
+        self.stale_count = 0
+        # ids below this are reserved in the store
+        self._id_limit = 0
+        epoch = None
+        if store is not None:
+            next_id = store.get_meta("next_id")
+            if next_id is None:
+                # nothing tells which ids were issued, so rows stored without `next_id` cannot be trusted
+                store.delete_before(float("inf"))
+                next_id = 0
+            self.id = self._id_limit = next_id
+            epoch = store.get_meta("epoch")
+        if epoch is None:
+            epoch = random.randrange(_EPOCH_COUNT)
+            if store is not None:
+                store.set_meta("epoch", epoch)
+        self.epoch = epoch
+        self._epoch_tag = encode_key(epoch, _EPOCH_LEN)
 
     def set_data(self, data=None) -> str:
         """
         store data and return the key to retrieve it later.
-        the key is a string of int.
         """
+        if self._store is not None and self.id >= self._id_limit:
+            self._id_limit = self.id + _ID_RESERVE_BLOCK
+            self._store.set_meta("next_id", self._id_limit)
         if data is not None:
             self._dict[self.id] = data
-            self.history.enqueue(self.id)
+            now = time.time()
+            if self._store is not None:
+                self._enqueued_at[self.id] = now
+            self.history.enqueue(self.id, now)
+            self._maintain()
         self.id += 1
-        return str(self.id - 1)
+        return self._epoch_tag + encode_key(self.id - 1)
+
+    def _parse_key(self, _id: Union[str, int]) -> Tuple[Optional[int], Optional[int]]:
+        """
+        return the id and the keyboard button index of a key. the id is `None` if the key is stale or invalid.
+        """
+        if isinstance(_id, int):
+            return _id, None
+        key, _, idx = _id.partition(KEYBOARD_INDEX_SEP)
+        n_id = decode_key(key[_EPOCH_LEN:]) if key.startswith(self._epoch_tag) else None
+        n_idx = decode_key(idx) if idx else None
+        if n_id is None or (idx and n_idx is None):
+            self.stale_count += 1
+            return None, None
+        return n_id, n_idx
+
+    def _maintain(self) -> None:
+        if self.ttl is not None:
+            self.sweep(_SWEEP_STEP)
+        if self.max_size is not None:
+            if self._store is not None:
+                self._spill(len(self._dict) - self.max_size)
+            # with a store, the entries left above max_size are keyboards, which are kept
+            while self._store is None and len(self._dict) > self.max_size:
+                key = self.history.pop_oldest()
+                if key is None:
+                    break
+                if self._dict.pop(key, None) is not None:
+                    self.evicted_count += 1
+        if len(self.history) > 2 * len(self._dict) + _HISTORY_COMPACT_SLACK:
+            self.history.retain(self._dict.__contains__)
+
+    def _spill(self, count: int, keep_keyboards: bool = True) -> None:
+        """
+        move `count` least recently used entries to disk. keyboards are kept in memory unless `keep_keyboards`
+        is False: modules may still hold them, and a spilled keyboard would come back as a copy.
+        """
+        assert self._store is not None
+        lru = cast("OrderedDict[int, Any]", self._dict)
+        # each entry is examined at most once, in case only keyboards are left
+        for _ in range(len(lru)):
+            if count <= 0:
+                break
+            key, value = lru.popitem(last=False)
+            if keep_keyboards and isinstance(value, PersistKeyboards):
+                lru[key] = value
+                continue
+            count -= 1
+            if self._store.put(key, value, self._enqueued_at.pop(key, None)):
+                self.spilled_count += 1
+            else:
+                self.evicted_count += 1
+
+    def _load(self, n_id: int) -> Any:
+        """
+        move an entry from disk back to memory.
+        """
+        if self._store is None:
+            return None
+        found, value = self._store.pop(n_id)
+        if not found or value is None:
+            return None
+        self.loaded_count += 1
+        if isinstance(value, PersistKeyboards):
+            value.cb_manager = self
+        self._dict[n_id] = value
+        now = time.time()
+        self._enqueued_at[n_id] = now
+        self.history.enqueue(n_id, now)
+        self._maintain()
+        return value
+
+    def sweep(self, max_count: Optional[int] = None) -> List[int]:
+        """
+        remove expired entries, at most `max_count` history items are examined.
+        return the removed keys.
+        """
+        if self.ttl is None:
+            return []
+        before = time.time() - self.ttl
+        removed = []
+        for key in self.history.pop_before_keys(before, max_count):
+            enqueued_at = self._enqueued_at.get(key)
+            if enqueued_at is not None:
+                if enqueued_at >= before:
+                    continue  # a newer history item exists
+                del self._enqueued_at[key]
+            if self._dict.pop(key, None) is not None:
+                removed.append(key)
+        self.expired_count += len(removed)
+        if self._store is not None and max_count is None:
+            self.expired_count += self._store.delete_before(before)
+            self._store.commit()
+        return removed
+
+    def close(self) -> None:
+        """
+        spill all entries to disk, if a store is used.
+        """
+        if self._store is None:
+            return
+        self._spill(len(self._dict), keep_keyboards=False)
+        self._store.set_meta("next_id", self.id)
+        self._store.close()
+        self._store = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        counters of the manager. memory sizes are shallow, in bytes.
+        """
+        ret = {
+            "size": len(self._dict),
+            "history_size": len(self.history),
+            "dict_memory": sys.getsizeof(self._dict),
+            "history_memory": self.history.memory_size(),
+            "evicted": self.evicted_count,
+            "expired": self.expired_count,
+            "stale": self.stale_count,
+        }
+        if self._store is not None:
+            ret["store_size"] = self._store.count()
+            ret["spilled"] = self.spilled_count
+            ret["loaded"] = self.loaded_count
+        return ret
 
     def pop_data(self, _id: Union[str, int]) -> Any:
         """
         pop the data by the key.
         """
-        n_id = int(_id)
-        return self._dict.pop(n_id, None)
+        n_id, idx = self._parse_key(_id)
+        if n_id is None:
+            return None
+        if idx is not None:
+            keyboard = self.peek_data(n_id)
+            return keyboard.pop_entry(idx) if isinstance(keyboard, PersistKeyboards) else None
+        self._enqueued_at.pop(n_id, None)
+        ret = self._dict.pop(n_id, None)
+        if ret is None and self._store is not None:
+            ret = self._store.pop(n_id)[1]
+        return ret
 
     def peek_data(self, _id: Union[str, int]) -> Any:
         """
         peek the data by the key.
         """
-        n_id = int(_id)
-        return self._dict.get(n_id, None)
+        n_id, idx = self._parse_key(_id)
+        if n_id is None:
+            return None
+        ret = self._dict.get(n_id, None)
+        if ret is None:
+            ret = self._load(n_id)
+        elif self._store is not None:
+            cast("OrderedDict[int, Any]", self._dict).move_to_end(n_id)
+        if idx is not None:
+            return ret.get_entry(idx) if isinstance(ret, PersistKeyboards) else None
+        return ret
 
     def modify_data(self, _id: Union[str, int], data: Any) -> None:
         """
-        modify the data by the key.
+        modify the data by the key. keys that expired or were popped are ignored.
         """
-        n_id = int(_id)
+        n_id, idx = self._parse_key(_id)
+        if n_id is None:
+            return
+        if idx is not None:
+            keyboard = self.peek_data(n_id)
+            if isinstance(keyboard, PersistKeyboards):
+                keyboard.set_entry(idx, None if data is None else data[0])
+            return
+        if n_id not in self._dict and self._load(n_id) is None:
+            # re-inserting it would leave an entry without history item, which never expires
+            return
         if data is not None:
             self._dict[n_id] = data
         else:
+            self._enqueued_at.pop(n_id, None)
             self._dict.pop(n_id, None)
 
 
+class CallbackKeyIndex:
+    """
+    Index of the callback data keys of sent messages, by `(chat_id, message_id)`.
+
+    Entries expire with the same ttl as the callback manager, and the oldest entries are evicted
+    above `max_size`. The keys of an expired or evicted message are popped from the callback manager
+    at the same time, so the payloads are released together with the index entry.
+    Expired entries are removed a few at a time on insertion, and the rest by calling `sweep`.
+    """
+    __slots__ = ("cb_manager", "max_size", "_dict", "expired_count", "evicted_count")
+
+    def __init__(self, cb_manager: CallbackDataManager, max_size: Optional[int] = None) -> None:
+        self.cb_manager = cb_manager
+        self.max_size = max_size
+        # ordered by insertion time
+        self._dict: Dict[Tuple[int, int], Tuple[float, List[str]]] = {}
+        self.expired_count = 0
+        self.evicted_count = 0
+
+    def __setitem__(self, msg_key: Tuple[int, int], cb_keys: List[str]) -> None:
+        self._dict.pop(msg_key, None)
+        self._dict[msg_key] = (time.time(), cb_keys)
+        self.sweep(_SWEEP_STEP)
+        if self.max_size is not None:
+            while len(self._dict) > self.max_size:
+                self._release(next(iter(self._dict)))
+                self.evicted_count += 1
+
+    def __getitem__(self, msg_key: Tuple[int, int]) -> List[str]:
+        return self._dict[msg_key][1]
+
+    def __contains__(self, msg_key: object) -> bool:
+        return msg_key in self._dict
+
+    def __len__(self) -> int:
+        return len(self._dict)
+
+    def get(self, msg_key: Tuple[int, int], default: Optional[List[str]] = None) -> Optional[List[str]]:
+        item = self._dict.get(msg_key)
+        return default if item is None else item[1]
+
+    def pop(self, msg_key: Tuple[int, int], default: Optional[List[str]] = None) -> Optional[List[str]]:
+        """
+        remove the entry and return its keys. the keys are NOT popped from the callback manager.
+        """
+        item = self._dict.pop(msg_key, None)
+        return default if item is None else item[1]
+
+    def _release(self, msg_key: Tuple[int, int]) -> None:
+        _, cb_keys = self._dict.pop(msg_key)
+        for key in cb_keys:
+            self.cb_manager.pop_data(key)
+
+    def sweep(self, max_count: Optional[int] = None) -> int:
+        """
+        release expired entries, at most `max_count` of them. return the number of released entries.
+        """
+        ttl = self.cb_manager.ttl
+        if ttl is None:
+            return 0
+        before = time.time() - ttl
+        count = 0
+        for msg_key, (created, _) in self._dict.items():
+            if created >= before or (max_count is not None and count >= max_count):
+                break
+            count += 1
+        for msg_key in list(itertools.islice(self._dict, count)):
+            self._release(msg_key)
+        self.expired_count += count
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._dict),
+            "expired": self.expired_count,
+            "evicted": self.evicted_count,
+        }
+
+
 class PersistKeyboards(Generic[_DataType]):
     """
     Parameter of repr_cb: idx, cb_data_key, data
@@ -86,13 +503,22 @@ class PersistKeyboards(Generic[_DataType]):
     When the data is retrieved:
     * the type of data is `Tuple[_DataType, PersistKeyboards[_DataType]]`.
     * the index can be retrieved by calling `self.idx(get_cb_data_key)`, where `get_cb_data_key = bot_module._get_cb_data_key(query)`.
+
+    With `single_entry=True`, the whole keyboard takes one entry of the callback manager,
+    and the button index is encoded in the callback data key, like `00Ab.3`.
+    The data is retrieved in the same way. Such keyboards stay in memory while the bot runs,
+    and are only written to the disk store by `CallbackDataManager.close`, without `repr_cb`.
+    A keyboard loaded after a restart is a new object.
     """
 
-    def __init__(self, cb_manager: CallbackDataManager) -> None:
+    def __init__(self, cb_manager: CallbackDataManager, single_entry: bool = False) -> None:
         self.cb_data_keys: List[str] = []
         self.repr_cb: Optional[Callable[[int, str, _DataType], str]] = None
         self.cb_manager = cb_manager
         self._idx_map: Dict[str, int] = dict()
+        self.single_entry = single_entry
+        self._entry_key: Optional[str] = None
+        self._data: List[Optional[_DataType]] = []
 
     def get_reply_markup(self, pattern_key: str, button_in_row: int) -> Optional["InlineKeyboardMarkup"]:
         """
@@ -126,18 +552,24 @@ class PersistKeyboards(Generic[_DataType]):
         """
         self.cb_data_keys = cb_data_keys
         self.repr_cb = repr_cb
-        for i, k in enumerate(cb_data_keys):
-            self._idx_map[k] = i
+        if not self.single_entry:
+            for i, k in enumerate(cb_data_keys):
+                self._idx_map[k] = i
 
     def modify_data(self, cb_data_key: str, data: _DataType) -> None:
         idx = self.idx(cb_data_key)
         self.modify_data_by_index(idx, data)
 
     def modify_data_by_index(self, idx: int, data: _DataType) -> None:
+        if self.single_entry:
+            self._data[idx] = data
+            return
         cb_data_key = self.cb_data_keys[idx]
         self.cb_manager.modify_data(cb_data_key, (data, self))
 
     def get_data_by_index(self, idx: int) -> _DataType:
+        if self.single_entry:
+            return cast(_DataType, self._data[idx])
         cb_data_key = self.cb_data_keys[idx]
         data: _DataType = self.cb_manager.peek_data(cb_data_key)[0]
         return data
@@ -145,25 +577,69 @@ class PersistKeyboards(Generic[_DataType]):
     def _get_text(self, idx: int) -> str:
         if self.repr_cb is None:
             return str(idx)
-        cb_data_key = self.cb_data_keys[idx]
-        data: _DataType = self.cb_manager.peek_data(cb_data_key)[0]
-        return self.repr_cb(idx, cb_data_key, data)
+        return self.repr_cb(idx, self.cb_data_keys[idx], self.get_data_by_index(idx))
 
     def idx(self, cb_data_key: str) -> int:
+        if self.single_entry:
+            return cast(int, decode_key(cb_data_key.rpartition(KEYBOARD_INDEX_SEP)[2]))
         return self._idx_map[cb_data_key]
 
     def store_data(self, data: _DataType) -> str:
+        if self.single_entry:
+            if self._entry_key is None:
+                self._entry_key = self.cb_manager.set_data(self)
+            self._data.append(data)
+            return f"{self._entry_key}{KEYBOARD_INDEX_SEP}{encode_key(len(self._data) - 1)}"
         return self.cb_manager.set_data((data, self))
 
+    def get_entry(self, idx: int) -> Optional[Tuple[_DataType, "PersistKeyboards[_DataType]"]]:
+        """
+        `(data, keyboard)` of a single-entry button, as `CallbackDataManager.peek_data` returns it
+        """
+        if not 0 <= idx < len(self._data) or self._data[idx] is None:
+            return None
+        return cast(_DataType, self._data[idx]), self
+
+    def pop_entry(self, idx: int) -> Optional[Tuple[_DataType, "PersistKeyboards[_DataType]"]]:
+        """
+        same as `get_entry`, and the button no longer has data
+        """
+        ret = self.get_entry(idx)
+        if ret is not None:
+            self._data[idx] = None
+        return ret
+
+    def set_entry(self, idx: int, data: Optional[_DataType]) -> None:
+        """
+        replace the data of a single-entry button, `None` removes it
+        """
+        if 0 <= idx < len(self._data):
+            self._data[idx] = data
+
     def clean(self) -> None:
         """
         clean all refs in callback manager when the keyboard is no longer used
         """
-        for k in self.cb_data_keys:
-            self.cb_manager.pop_data(k)
+        if self.single_entry:
+            if self._entry_key is not None:
+                self.cb_manager.pop_data(self._entry_key)
+            self._entry_key = None
+            self._data = []
+        else:
+            for k in self.cb_data_keys:
+                self.cb_manager.pop_data(k)
         self.cb_data_keys = []
         self._idx_map.clear()
         self.repr_cb = None
 
     def __len__(self) -> int:
         return len(self.cb_data_keys)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # only a single entry keyboard is stored as a whole; the callback manager is attached again when it is loaded
+        if not self.single_entry:
+            raise TypeError("only single entry keyboards can be pickled")
+        state = self.__dict__.copy()
+        state["cb_manager"] = None
+        state["repr_cb"] = None
+        return state
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import hmac
+import struct
+from typing import Any, List, Optional, Tuple
+
+
+# marks a signed payload in the callback data, like `key:~xxxx`. not a base 64 digit
+SIGNED_PAYLOAD_PREFIX = "~"
+# bytes of the truncated HMAC-SHA256 tag
+SIGNATURE_SIZE = 8
+# Telegram limit of `InlineKeyboardButton.callback_data`, in bytes
+CALLBACK_DATA_MAX_SIZE = 64
+
+_T_NONE = 0
+_T_TRUE = 1
+_T_FALSE = 2
+_T_INT = 3
+_T_STR = 4
+_T_BYTES = 5
+_T_TUPLE = 6
+_T_LIST = 7
+_T_FLOAT = 8
+_FLOAT_STRUCT = struct.Struct(">d")
+
+
+def _write_varint(out: bytearray, n: int) -> None:
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _dump(out: bytearray, value: Any) -> None:
+    if value is None:
+        out.append(_T_NONE)
+    elif value is True:
+        out.append(_T_TRUE)
+    elif value is False:
+        out.append(_T_FALSE)
+    elif isinstance(value, int):
+        out.append(_T_INT)
+        _write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)  # zigzag
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+        out.append(_T_STR)
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, bytes):
+        out.append(_T_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (tuple, list)):
+        out.append(_T_TUPLE if isinstance(value, tuple) else _T_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _dump(out, item)
+    elif isinstance(value, float):
+        out.append(_T_FLOAT)
+        out += _FLOAT_STRUCT.pack(value)
+    else:
+        raise TypeError(f"cannot serialize {type(value).__name__} into callback data")
+
+
+def _load(buf: bytes, pos: int) -> Tuple[Any, int]:
+    tag = buf[pos]
+    pos += 1
+    if tag == _T_NONE:
+        return None, pos
+    if tag == _T_TRUE:
+        return True, pos
+    if tag == _T_FALSE:
+        return False, pos
+    if tag == _T_INT:
+        n, pos = _read_varint(buf, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == _T_STR or tag == _T_BYTES:
+        size, pos = _read_varint(buf, pos)
+        raw = buf[pos:pos + size]
+        if len(raw) != size:
+            raise ValueError("truncated payload")
+        return (raw.decode("utf-8") if tag == _T_STR else raw), pos + size
+    if tag == _T_TUPLE or tag == _T_LIST:
+        count, pos = _read_varint(buf, pos)
+        items: List[Any] = []
+        for _ in range(count):
+            item, pos = _load(buf, pos)
+            items.append(item)
+        return (tuple(items) if tag == _T_TUPLE else items), pos
+    if tag == _T_FLOAT:
+        return _FLOAT_STRUCT.unpack_from(buf, pos)[0], pos + _FLOAT_STRUCT.size
+    raise ValueError(f"unknown type tag {tag}")
+
+
+def dumps_payload(value: Any) -> bytes:
+    """
+    serialize None, bool, int, float, str, bytes and tuples or lists of them into a compact binary form.
+    """
+    out = bytearray()
+    _dump(out, value)
+    return bytes(out)
+
+
+def loads_payload(buf: bytes) -> Any:
+    value, pos = _load(buf, 0)
+    if pos != len(buf):
+        raise ValueError("trailing bytes in payload")
+    return value
+
+
+class SignedCallbackCodec:
+    """
+    Serialize small payloads directly into callback data, so that nothing is stored in `CallbackDataManager`.
+    The payload is signed with a truncated HMAC over the pattern key and the payload, then base64url encoded.
+    A payload is only accepted by the pattern key it was made for, and stays valid as long as the secret does.
+    """
+    __slots__ = ("_secret",)
+
+    def __init__(self, secret: bytes) -> None:
+        self._secret = secret
+
+    @classmethod
+    def from_token(cls, token: str) -> "SignedCallbackCodec":
+        """
+        derive the secret from the bot token, so it is stable across restarts without extra configuration.
+        """
+        return cls(hashlib.sha256(b"antares_bot callback payload\0" + token.encode("utf-8")).digest())
+
+    def _sign(self, key: str, payload: bytes) -> bytes:
+        return hmac.new(self._secret, key.encode("utf-8") + b"\0" + payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def encode(self, key: str, value: Any) -> str:
+        """
+        return the callback data key (the part after the colon) of `value` for the pattern `key`.
+        raise `ValueError` if the callback data would exceed the Telegram limit.
+        """
+        payload = dumps_payload(value)
+        raw = self._sign(key, payload) + payload
+        ret = SIGNED_PAYLOAD_PREFIX + base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+        size = len(key.encode("utf-8")) + 1 + len(ret)
+        if size > CALLBACK_DATA_MAX_SIZE:
+            raise ValueError(f"callback payload too large: {size} bytes")
+        return ret
+
+    def decode(self, key: str, cb_data_key: str) -> Tuple[bool, Optional[Any]]:
+        """
+        return `(True, value)` if `cb_data_key` is a valid payload signed for the pattern `key`, else `(False, None)`.
+        """
+        if not cb_data_key.startswith(SIGNED_PAYLOAD_PREFIX):
+            return False, None
+        encoded = cb_data_key[len(SIGNED_PAYLOAD_PREFIX):]
+        try:
+            raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        except ValueError:
+            return False, None
+        tag, payload = raw[:SIGNATURE_SIZE], raw[SIGNATURE_SIZE:]
+        if len(tag) != SIGNATURE_SIZE or not hmac.compare_digest(tag, self._sign(key, payload)):
+            return False, None
+        try:
+            return True, loads_payload(payload)
+        except (ValueError, IndexError, struct.error):
+            return False, None
+
+    @staticmethod
+    def is_signed(cb_data_key: str) -> bool:
+        return cb_data_key.startswith(SIGNED_PAYLOAD_PREFIX)
@@ -196,6 +196,11 @@ async def _btn_pre_executer(update: Update, context: "RichCallbackContext"):
 def btn_click_wrapper(
         pattern: Optional[Union[str, Pattern[str], type, Callable[[object], Optional[bool]]]] = None
 ):
+    """
+    callback query handler wrapper.
+    a str `pattern` matches the callback data starting with it. If it is a plain key without colon,
+    data like `key:xxx` is routed to the handler by a dict lookup instead of regex matching.
+    """
     if isinstance(pattern, str):
         # startswith `pattern`
         pattern = re.compile(f"^{pattern}")
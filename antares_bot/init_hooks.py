@@ -43,6 +43,35 @@ class AntaresBotConfig:
     # SKIP_LOAD_INTERNAL_MODULE_{module_name_upper_case} = True
     # SKIP_LOAD_MODULE_{module_name_upper_case} = True
     # OBJGRAPH_TRACE_AT_START = True
+    # SKIP_COMMAND_DISPATCH_INDEX = True  # check command handlers one by one as plain PTB does
+    # SKIP_CALLBACK_QUERY_DISPATCH_INDEX = True  # check callback query handlers one by one as plain PTB does
+    # SKIP_SEND_RATE_LIMIT = True  # disable the built-in outbound rate limiter
+    # SEND_RATE_LIMIT_CONFIG = {
+    #     "global_per_second": 30,
+    #     "private_per_second": 1,
+    #     "group_per_minute": 20,
+    # }
+    # WEBHOOK_CONFIG = {  # receive updates by webhook instead of polling. Needs `pip install antares_bot[webhook]`
+    #     "listen": "127.0.0.1",
+    #     "port": 8443,
+    #     "url_path": "bot",
+    #     "webhook_url": "https://example.com/bot",  # public url, e.g. of a reverse proxy
+    #     "secret_token": "some_secret",
+    #     "workers": 32,  # number of updates processed concurrently
+    #     "queue_size": 1024,  # updates waiting for a free worker, 0 for unbounded. The webhook waits when it is full
+    # }
+    # CALLBACK_DATA_CONFIG = {  # storage of button callback data
+    #     "max_size": 100000,  # evict the oldest entries above this size. Unbounded by default
+    #     "persist": False,  # spill the least recently used entries above max_size (default 10000) to DATA_DIR/callback_data.db, kept across restarts
+    #     "ttl": 86400,  # seconds before an entry expires, None for never
+    #     "sweep_interval": 60,  # seconds between two sweeps of expired entries
+    #     "max_messages": 65536,  # messages tracked by `cache_cb_keys_by_id`. the keys of the oldest ones are released above this size
+    #     "signing_key": "some_secret",  # secret of signed callback payloads. Derived from the token by default
+    # }
+    # CHAT_LANE_CONFIG = {  # process updates of a chat in order, different chats in parallel. All handlers become blocking
+    #     "max_concurrent_updates": 256,  # defaults to webhook workers in webhook mode
+    # }
+    # SQLITE_SHARED_WORKERS = 2  # run the sqlite connections of all databases on this many shared threads, instead of one thread each
     # SYSTEMD_SERVICE_NAME = "antares_bot.service"
     # IGNORE_IMPORT_MODULE_ERROR = True
 """
@@ -8,6 +8,7 @@ from telegram.ext import ConversationHandlerEx
 
 from antares_bot.basic_language import BasicLanguage as L
 from antares_bot.bot_base import TelegramBotBase
+from antares_bot.callback_payload import SignedCallbackCodec
 from antares_bot.error import InvalidQueryException
 from antares_bot.framework import command_callback_wrapper
 from antares_bot.utils import exception_manual_handle
@@ -85,6 +86,21 @@ class TelegramBotModuleBase(TelegramBotBase):
             keys.append(f"{key}:{key_raw}")
         return raw_keys, keys
 
+    def make_btn_signed_callback(self, key: str, data: Iterable) -> List[str]:
+        """
+        return a list of callback data strings carrying the data itself, signed, so that nothing is stored
+        in callback manager and the buttons survive restarts. No need to cache or clean the keys.
+        The data must be small: None, bool, int, float, str, bytes, or tuples and lists of them.
+        Raise `ValueError` if `key` contains a colon, which separates it from the payload,
+        or if the callback data would exceed 64 bytes.
+
+        `get_btn_callback_data` returns the data as is.
+        """
+        if ":" in key:
+            raise ValueError(f"callback key must not contain ':': {key}")
+        codec = self.parent.callback_codec
+        return [f"{key}:{codec.encode(key, dt)}" for dt in data]
+
     def _get_cb_data_key(self, query: "CallbackQuery"):
         """
         generally the data format stored in callback manager is `key:xxx`.
@@ -96,12 +112,18 @@ class TelegramBotModuleBase(TelegramBotBase):
     def get_btn_callback_data(self, query: "CallbackQuery", pop: bool = False, check_valid=False):
         """
         get button callback data from callback manager from query.
-        if `pop` is True, the data will be removed from callback manager.
-        if `check_valid` is True, it will call `on_invalid_query` if the data is `None`.
+        if `pop` is True, the data will be removed from callback manager. signed payloads are only verified and decoded.
+        if `check_valid` is True, it will call `on_invalid_query` if the data is `None`,
+        or if a signed payload fails verification (a verified `None` payload is valid).
         """
         k = self._get_cb_data_key(query)
-        ret = self.parent.callback_manager.pop_data(k) if pop else self.parent.callback_manager.peek_data(k)
-        if ret is None and check_valid:
+        if SignedCallbackCodec.is_signed(k):
+            assert query.data is not None
+            valid, ret = self.parent.callback_codec.decode(query.data.split(':')[0], k)
+        else:
+            ret = self.parent.callback_manager.pop_data(k) if pop else self.parent.callback_manager.peek_data(k)
+            valid = ret is not None
+        if not valid and check_valid:
             loop = asyncio.get_running_loop()
             loop.create_task(self.on_invalid_query(query))
             raise InvalidQueryException
@@ -0,0 +1,191 @@
+import re
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from telegram import MessageEntity, Update
+from telegram.ext import BaseHandler, CallbackQueryHandler, CommandHandler
+
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+    from antares_bot.context import RichCallbackContext
+
+
+async def _never_called(update: object, context: Any) -> None:
+    raise RuntimeError("dispatch handlers only dispatch to the indexed handlers")
+
+
+class _DispatchHandlerBase(BaseHandler[Update, "RichCallbackContext"]):
+    """
+    Base of handlers that find the handler of an update through an index,
+    instead of letting the application check every handler in turn.
+    If no handler is found, the application goes on with the other handlers of the group.
+    The `block` setting of the found handler is respected.
+    """
+    __slots__ = ()
+
+    def __init__(self) -> None:
+        super().__init__(_never_called)
+
+    def _find_handler(self, update: object) -> Tuple[Optional[BaseHandler], Any]:
+        raise NotImplementedError
+
+    def check_update(self, update: object) -> Optional[Tuple[BaseHandler, Any]]:
+        handler, check = self._find_handler(update)
+        return None if handler is None else (handler, check)
+
+    async def do_process_atom(
+        self,
+        context: Optional["RichCallbackContext"],
+        update: object,
+        app: "Application[Any, RichCallbackContext, Any, Any, Any, Any]",
+    ) -> Tuple[bool, Optional["RichCallbackContext"], bool]:
+        handler, check = self._find_handler(update)
+        if handler is None:
+            return False, context, False
+        if not context:  # build a context if not already built
+            context = app.context_types.context.from_update(update, app)
+            await context.refresh_data()
+        coroutine = handler.handle_update(update, app, check, context)  # type: ignore
+        is_blocking = await app.do_process_update(handler, update, coroutine)
+        return True, context, is_blocking
+
+    @staticmethod
+    def _first_match(handlers, update: object) -> Tuple[Optional[BaseHandler], Any]:
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler, check
+        return None, None
+
+
+class CommandDispatchHandler(_DispatchHandlerBase):
+    """
+    Dispatch command updates through an index keyed by command name.
+    `/command@bot_username` is only dispatched if the username is the bot's own.
+    """
+    __slots__ = ("_index",)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._index: Dict[str, List[CommandHandler]] = {}
+
+    def add_handler(self, handler: CommandHandler) -> None:
+        for command in handler.commands:
+            self._index.setdefault(command, []).append(handler)
+
+    @property
+    def commands(self) -> List[str]:
+        return list(self._index.keys())
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @staticmethod
+    def _parse_command(update: object) -> Optional[str]:
+        if not isinstance(update, Update):
+            return None
+        message = update.effective_message
+        if message is None or not message.entities or not message.text:
+            return None
+        entity = message.entities[0]
+        if entity.type != MessageEntity.BOT_COMMAND or entity.offset != 0:
+            return None
+        command, _, username = message.text[1:entity.length].partition("@")
+        if username and username.lower() != message.get_bot().username.lower():
+            return None
+        return command.lower()
+
+    def _find_handler(self, update: object) -> Tuple[Optional[BaseHandler], Any]:
+        command = self._parse_command(update)
+        if command is None:
+            return None, None
+        return self._first_match(self._index.get(command, ()), update)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}[{len(self._index)} commands]"
+
+
+class CallbackQueryDispatchHandler(_DispatchHandlerBase):
+    """
+    Dispatch callback queries with data like `key:xxx` through an index keyed by `key`.
+
+    A handler is indexed if its pattern is `^key` with a literal `key`, which is what
+    `btn_click_wrapper("key")` produces. Such a handler can only match data starting with its key,
+    so only the handlers indexed by a prefix of the data before the first colon are checked,
+    together with the handlers that are not indexed, in the order they were added.
+    """
+    __slots__ = ("_index", "_unindexed", "_handlers")
+
+    def __init__(self) -> None:
+        super().__init__()
+        # key -> [(position, handler), ...]
+        self._index: Dict[str, List[Tuple[int, CallbackQueryHandler]]] = {}
+        self._unindexed: List[Tuple[int, CallbackQueryHandler]] = []
+        self._handlers: List[CallbackQueryHandler] = []
+
+    @staticmethod
+    def _get_literal_key(handler: CallbackQueryHandler) -> Optional[str]:
+        pattern = handler.pattern
+        if not isinstance(pattern, re.Pattern) or not isinstance(pattern.pattern, str) or pattern.flags & re.IGNORECASE:
+            return None
+        if not pattern.pattern.startswith("^"):
+            return None
+        key = pattern.pattern[1:]
+        if not key or ":" in key or re.escape(key) != key:
+            return None
+        return key
+
+    def add_handler(self, handler: CallbackQueryHandler) -> None:
+        item = (len(self._handlers), handler)
+        self._handlers.append(handler)
+        key = self._get_literal_key(handler)
+        if key is not None:
+            self._index.setdefault(key, []).append(item)
+        else:
+            self._unindexed.append(item)
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+    def _find_handler(self, update: object) -> Tuple[Optional[BaseHandler], Any]:
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None, None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return self._first_match(self._handlers, update)
+        head = data.partition(":")[0]
+        candidates = list(self._unindexed)
+        for end in range(1, len(head) + 1):
+            candidates.extend(self._index.get(head[:end], ()))
+        if len(candidates) > 1:
+            candidates.sort(key=lambda item: item[0])
+        return self._first_match((handler for _, handler in candidates), update)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}[{len(self._index)} keys, {len(self._handlers)} handlers]"
+
+
+def add_handler(application: "Application", handler: BaseHandler, index_commands: bool = True, index_callback_queries: bool = True) -> None:
+    """
+    Add `handler` to the default group of `application`. Plain command handlers and callback query handlers
+    go to a dispatch handler instead: the last handler of the group if it is a dispatch handler of their kind,
+    else a new one added to the group. So handlers are still checked in the order they were added.
+    """
+    kind: Optional[type] = None
+    # pylint: disable=unidiomatic-typecheck
+    if index_commands and type(handler) is CommandHandler:
+        kind = CommandDispatchHandler
+    elif index_callback_queries and type(handler) is CallbackQueryHandler:
+        kind = CallbackQueryDispatchHandler
+    # pylint: enable=unidiomatic-typecheck
+    if kind is None:
+        application.add_handler(handler)
+        return
+    # 0 is the default group of `Application.add_handler`
+    group = application.handlers.get(0)
+    dispatcher = group[-1] if group else None
+    if not isinstance(dispatcher, kind):
+        dispatcher = kind()
+        application.add_handler(dispatcher)
+    dispatcher.add_handler(handler)  # type: ignore
@@ -0,0 +1,90 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class _ChatLane:
+    __slots__ = ("lock", "waiting")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates of the same chat one by one in arrival order, and updates of
+    different chats in parallel, with at most `max_concurrent_updates` updates in flight.
+
+    An update waits for its chat lane before taking a global slot, so a busy chat
+    never occupies the slots needed by other chats.
+    Updates without a chat (e.g. inline queries) only take a global slot.
+
+    Handlers must run blocking (`block=True`) for the order to hold.
+    """
+    __slots__ = ("_lanes", "_in_flight")
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._lanes: Dict[int, _ChatLane] = {}
+        self._in_flight = 0
+
+    @staticmethod
+    def _get_lane_key(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    # `BaseUpdateProcessor.process_update` is final, and takes the global semaphore before calling
+    # `do_process_update`. Waiting for the chat lane inside it would let the updates queued behind
+    # a busy chat hold all the slots, so the lane has to be taken before the semaphore, here.
+    # The alternatives need the private semaphore replaced, or a wrong `max_concurrent_updates`
+    # reported to the application. Same contract as the base: `do_process_update` under the semaphore.
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:  # type: ignore[misc]  # pylint: disable=overridden-final-method
+        key = self._get_lane_key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _ChatLane()
+        lane.waiting += 1
+        acquired = False
+        try:
+            async with lane.lock:
+                lane.waiting -= 1
+                acquired = True
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            if not acquired:
+                lane.waiting -= 1
+            if lane.waiting == 0 and not lane.lock.locked():
+                self._lanes.pop(key, None)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self._in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self._in_flight -= 1
+
+    async def initialize(self) -> None:
+        ...
+
+    async def shutdown(self) -> None:
+        ...
+
+    def queue_depths(self) -> Dict[str, Any]:
+        """
+        Return the number of updates in flight, the number of updates waiting, and the waiting updates of each chat.
+        """
+        chats = {k: lane.waiting for k, lane in self._lanes.items() if lane.waiting > 0}
+        return {
+            "in_flight": self._in_flight,
+            "waiting": sum(chats.values()),
+            "chats": chats,
+        }
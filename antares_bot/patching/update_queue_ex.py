@@ -0,0 +1,39 @@
+import asyncio
+from typing import Any
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """
+    Update queue of the application, which also bounds the number of updates in flight.
+
+    With concurrent updates, PTB takes each update off the queue at once and processes it in a new task,
+    so a bounded queue alone never fills up. Here `get` waits until fewer than `max_in_flight` updates
+    are taken and not yet marked done (PTB calls `task_done` once an update is processed).
+    When all slots are busy the queue fills up, and the webhook handler waits in `put`,
+    and so does Telegram.
+    """
+
+    def __init__(self, maxsize: int = 0, max_in_flight: int = 1) -> None:
+        super().__init__(maxsize)
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be a positive integer")
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._slot_freed = asyncio.Event()
+
+    async def get(self) -> Any:
+        while self.in_flight >= self.max_in_flight:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        return await super().get()
+
+    def get_nowait(self) -> Any:
+        # also called by `get`. updates drained at shutdown take a slot too, and release it in `task_done`
+        item = super().get_nowait()
+        self.in_flight += 1
+        return item
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.in_flight -= 1
+        self._slot_freed.set()
@@ -0,0 +1,198 @@
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+
+from antares_bot.bot_default_cfg import AntaresBotConfig
+from antares_bot.bot_logging import get_logger
+from antares_bot.utils import read_user_cfg
+
+
+_LOGGER = get_logger(__name__)
+
+# Telegram flood control budgets, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_PER_SECOND = 30
+PRIVATE_PER_SECOND = 1
+GROUP_PER_MINUTE = 20
+
+# idle chat buckets are collected when there are more than this many of them
+_CHAT_BUCKETS_GC_THRESHOLD = 1024
+
+
+class _TokenBucket:
+    """
+    A FIFO token bucket. `acquire` waits until a token is available instead of failing.
+    `blocked_for` returns how long the lane is still blocked by flood control;
+    it is checked while holding the lock so that the whole lane pauses.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "last", "lock", "waiting")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self, blocked_for: Callable[[], float]) -> None:
+        self.waiting += 1
+        try:
+            async with self.lock:
+                while True:
+                    wait = blocked_for()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                        continue
+                    self._refill(time.monotonic())
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+    def is_idle(self) -> bool:
+        if self.waiting > 0:
+            return False
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class SendRateLimiter:
+    """
+    Outbound rate limiter shared by all send methods of `TelegramBotBaseWrapper`.
+    A send call first waits for its chat lane, then for the global lane.
+
+    It also keeps a shared "blocked until" table filled by `block` when Telegram answers
+    with `RetryAfter`, so that one 429 pauses every sender of the lane. The table is
+    honored even if rate limiting is disabled.
+
+    Configure with `AntaresBotConfig.SEND_RATE_LIMIT_CONFIG`, or disable it
+    with `AntaresBotConfig.SKIP_SEND_RATE_LIMIT`.
+    """
+    INST: "SendRateLimiter" = None  # type: ignore
+
+    @classmethod
+    def get_inst(cls):
+        if cls.INST is None:
+            cls.INST = cls.from_config()
+        return cls.INST
+
+    @classmethod
+    def from_config(cls):
+        cfg = read_user_cfg(AntaresBotConfig, "SEND_RATE_LIMIT_CONFIG") or {}
+        return cls(
+            global_per_second=cfg.get("global_per_second", GLOBAL_PER_SECOND),
+            private_per_second=cfg.get("private_per_second", PRIVATE_PER_SECOND),
+            group_per_minute=cfg.get("group_per_minute", GROUP_PER_MINUTE),
+            enabled=not read_user_cfg(AntaresBotConfig, "SKIP_SEND_RATE_LIMIT"),
+        )
+
+    def __init__(
+        self,
+        global_per_second: float = GLOBAL_PER_SECOND,
+        private_per_second: float = PRIVATE_PER_SECOND,
+        group_per_minute: float = GROUP_PER_MINUTE,
+        enabled: bool = True,
+    ) -> None:
+        self.enabled = enabled
+        self.private_per_second = private_per_second
+        self.group_per_minute = group_per_minute
+        self._global_bucket = _TokenBucket(global_per_second, global_per_second)
+        self._chat_buckets: Dict[int, _TokenBucket] = {}
+        # monotonic time until which a lane is blocked by flood control. key `None` is the global lane
+        self._blocked_until: Dict[Optional[int], float] = {}
+
+    @staticmethod
+    def is_private_chat_id(chat_id: int) -> bool:
+        # users have positive ids, groups and channels have negative ids
+        return chat_id > 0
+
+    def _get_chat_bucket(self, chat_id: int) -> _TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= _CHAT_BUCKETS_GC_THRESHOLD:
+                self._collect_idle_buckets()
+            if self.is_private_chat_id(chat_id):
+                bucket = _TokenBucket(self.private_per_second, 1)
+            else:
+                bucket = _TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _collect_idle_buckets(self) -> None:
+        idle = [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_idle()]
+        for chat_id in idle:
+            del self._chat_buckets[chat_id]
+        _LOGGER.debug("collected %d idle chat buckets", len(idle))
+
+    def block(self, chat_id: Optional[int], retry_after: float) -> None:
+        """
+        Block the lane of `chat_id` (or the global lane if `chat_id` is `None`) for `retry_after` seconds.
+        """
+        if not isinstance(chat_id, int):
+            chat_id = None
+        until = time.monotonic() + retry_after
+        if until > self._blocked_until.get(chat_id, 0.):
+            self._blocked_until[chat_id] = until
+            _LOGGER.warning("flood control: lane %s blocked for %.1fs", "global" if chat_id is None else chat_id, retry_after)
+
+    def _lane_blocked_for(self, chat_id: Optional[int]) -> float:
+        until = self._blocked_until.get(chat_id)
+        if until is None:
+            return 0.
+        wait = until - time.monotonic()
+        if wait <= 0:
+            self._blocked_until.pop(chat_id, None)
+        return wait
+
+    def blocked_for(self, chat_id: Optional[int] = None) -> float:
+        """
+        Return how many seconds a send to `chat_id` still has to wait due to flood control.
+        """
+        wait = self._lane_blocked_for(None)
+        if isinstance(chat_id, int):
+            wait = max(wait, self._lane_blocked_for(chat_id))
+        return max(wait, 0.)
+
+    async def acquire(self, chat_id: Optional[int] = None) -> None:
+        """
+        Wait until a message can be sent to `chat_id`.
+        If `chat_id` is `None` (or not an int, e.g. `@channel_name`), only the global budget is applied.
+        """
+        if not isinstance(chat_id, int):
+            chat_id = None
+        if not self.enabled:
+            while (wait := self.blocked_for(chat_id)) > 0:
+                await asyncio.sleep(wait)
+            return
+        if chat_id is not None:
+            await self._get_chat_bucket(chat_id).acquire(lambda: self.blocked_for(chat_id))
+        await self._global_bucket.acquire(lambda: self._lane_blocked_for(None))
+
+    def blocked_lanes(self) -> Dict[Optional[int], float]:
+        """
+        Return the remaining blocked seconds of every blocked lane. key `None` is the global lane.
+        """
+        now = time.monotonic()
+        return {k: until - now for k, until in self._blocked_until.items() if until > now}
+
+    def global_queue_depth(self) -> int:
+        return self._global_bucket.waiting
+
+    def chat_queue_depth(self, chat_id: int) -> int:
+        bucket = self._chat_buckets.get(chat_id)
+        return 0 if bucket is None else bucket.waiting
+
+    def queue_depths(self) -> Dict[str, object]:
+        """
+        Return the number of waiting send calls: the global lane, and every chat lane that has waiters.
+        """
+        return {
+            "global": self._global_bucket.waiting,
+            "chats": {chat_id: bucket.waiting for chat_id, bucket in self._chat_buckets.items() if bucket.waiting > 0},
+        }
@@ -0,0 +1,145 @@
+import os
+import pickle
+import sqlite3
+import time
+from typing import Any, Optional, Tuple
+
+from antares_bot.bot_logging import get_logger
+from antares_bot.sqlite.creater import BLOB, INT, REAL, TEXT, TableDeclarer
+
+
+_LOGGER = get_logger(__name__)
+
+CALLBACK_DATA_TABLE = "callback_data"
+CALLBACK_META_TABLE = "callback_meta"
+
+
+class CallbackDataStore:
+    """
+    Disk store for the cold entries of `CallbackDataManager`.
+
+    `CallbackDataManager` has a synchronous interface, so this store talks to sqlite3 directly
+    instead of through `Database`. All statements are primary key lookups on a local file in WAL mode,
+    and commits are deferred to `commit`, which is called periodically.
+    Values are pickled; values that cannot be pickled are not stored, and values that cannot be
+    unpickled any more are dropped as if missing.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.conn: Optional[sqlite3.Connection] = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self._create_table()
+
+    @staticmethod
+    def _table_declarer() -> TableDeclarer:
+        return (
+            TableDeclarer()
+            .set_table_name(CALLBACK_DATA_TABLE)
+            .declare_col("id", INT, is_primary=True)
+            .declare_col("created", REAL, is_not_null=True)
+            .declare_col("data", BLOB, is_not_null=True)
+        )
+
+    @staticmethod
+    def _meta_table_declarer() -> TableDeclarer:
+        return (
+            TableDeclarer()
+            .set_table_name(CALLBACK_META_TABLE)
+            .declare_col("name", TEXT, is_primary=True)
+            .declare_col("value", INT, is_not_null=True)
+        )
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self.conn is None:
+            raise RuntimeError("Callback data store closed")
+        return self.conn
+
+    def _table_exists(self, table_name: str) -> bool:
+        found = self._get_conn().execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,)).fetchone()
+        return found is not None
+
+    def _create_table(self) -> None:
+        conn = self._get_conn()
+        if not self._table_exists(CALLBACK_DATA_TABLE):
+            command = self._table_declarer().get_creation_cmd()
+            _LOGGER.warning(command)
+            conn.execute(command)
+            conn.execute(f"CREATE INDEX idx_{CALLBACK_DATA_TABLE}_created ON {CALLBACK_DATA_TABLE} (created);")
+        if not self._table_exists(CALLBACK_META_TABLE):
+            command = self._meta_table_declarer().get_creation_cmd()
+            _LOGGER.warning(command)
+            conn.execute(command)
+        conn.commit()
+
+    def get_meta(self, name: str) -> Optional[int]:
+        row = self._get_conn().execute(f"SELECT value FROM {CALLBACK_META_TABLE} WHERE name=?;", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, name: str, value: int) -> None:
+        conn = self._get_conn()
+        conn.execute(f"INSERT OR REPLACE INTO {CALLBACK_META_TABLE} (name, value) VALUES (?, ?);", (name, value))
+        conn.commit()
+
+    def put(self, key: int, value: Any, created: Optional[float] = None) -> bool:
+        """
+        store the value. return `False` if it cannot be pickled.
+        """
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            _LOGGER.debug("cannot spill callback data %d: %s", key, e)
+            return False
+        self._get_conn().execute(
+            f"INSERT OR REPLACE INTO {CALLBACK_DATA_TABLE} (id, created, data) VALUES (?, ?, ?);",
+            (key, time.time() if created is None else created, blob),
+        )
+        return True
+
+    def get(self, key: int) -> Tuple[bool, Any]:
+        row = self._get_conn().execute(f"SELECT data FROM {CALLBACK_DATA_TABLE} WHERE id=?;", (key,)).fetchone()
+        if row is None:
+            return False, None
+        try:
+            return True, pickle.loads(row[0])
+        except Exception as e:
+            # e.g. the class of the value was renamed or removed by a deploy
+            _LOGGER.warning("cannot load callback data %d, dropped: %s", key, e)
+            self.delete(key)
+            return False, None
+
+    def pop(self, key: int) -> Tuple[bool, Any]:
+        found, value = self.get(key)
+        if found:
+            self.delete(key)
+        return found, value
+
+    def delete(self, key: int) -> None:
+        self._get_conn().execute(f"DELETE FROM {CALLBACK_DATA_TABLE} WHERE id=?;", (key,))
+
+    def delete_before(self, before: float) -> int:
+        cursor = self._get_conn().execute(f"DELETE FROM {CALLBACK_DATA_TABLE} WHERE created<?;", (before,))
+        return cursor.rowcount
+
+    def max_key(self) -> int:
+        """
+        return the largest stored key, or -1 if empty.
+        """
+        row = self._get_conn().execute(f"SELECT MAX(id) FROM {CALLBACK_DATA_TABLE};").fetchone()
+        return -1 if row is None or row[0] is None else row[0]
+
+    def count(self) -> int:
+        return self._get_conn().execute(f"SELECT COUNT(*) FROM {CALLBACK_DATA_TABLE};").fetchone()[0]
+
+    def commit(self) -> None:
+        self._get_conn().commit()
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
@@ -1,5 +1,8 @@
+import asyncio
 import os
-from typing import Any, Dict
+import sqlite3
+import zlib
+from typing import Any, Dict, List, Optional, Set
 
 import aiosqlite
 
@@ -14,6 +17,19 @@ REAL = "REAL"
 BLOB = "BLOB"
 NUMERIC = "NUMERIC"
 
+# rows copied at a time when a table is rebuilt by a migration
+MIGRATION_CHUNK_SIZE = 10000
+# private table of `DbDeclarer`, holds the fingerprint of the validated schema
+SCHEMA_META_TABLE = "antares_schema_meta"
+SCHEMA_FINGERPRINT_KEY = "schema_fingerprint"
+# columns of all tables in one query, rows are (table name, cid, name, type, notnull, dflt_value, pk)
+TABLE_COLUMNS_QUERY = """SELECT m.name AS table_name, p.cid, p.name, p.type, p."notnull", p.dflt_value, p.pk
+FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+WHERE m.type='table' AND m.name != '{}' ORDER BY m.name, p.cid""".format(SCHEMA_META_TABLE)
+# columns with a single-column UNIQUE constraint of a table
+UNIQUE_COLUMNS_QUERY = """SELECT MIN(i.name) FROM pragma_index_list(?) AS l JOIN pragma_index_info(l.name) AS i
+WHERE l.origin = 'u' GROUP BY l.name HAVING COUNT(*) = 1"""
+
 
 class NoTableException(Exception):
     pass
@@ -40,12 +56,67 @@ class ColumnDeclarer(object):
         self.is_unique = is_unique
         self.default = default
 
+    def get_default_literal(self) -> str:
+        if self.column_type == TEXT:
+            return "'{}'".format(self.default)
+        return "{}".format(self.default)
+
+    def matches(self, row: Any, unique_columns: Set[str]) -> bool:
+        """
+        Whether a `PRAGMA table_info` row (cid, name, type, notnull, dflt_value, pk) matches the declaration.
+        """
+        return (
+            row[2].upper() == self.column_type.upper()
+            and (row[5] > 0) == self.is_primary
+            and (row[3] > 0) == self.is_not_null
+            and row[4] == (None if self.default is None else self.get_default_literal())
+            and (self.column_name in unique_columns) == self.is_unique
+        )
+
+    def get_definition(self, inline_primary: bool = True):
+        """
+        Returns the column definition used in `CREATE TABLE` and `ALTER TABLE ADD COLUMN`.
+        """
+        execute_str = "{} {} ".format(self.column_name, self.column_type)
+        if self.is_primary and inline_primary:
+            execute_str += "PRIMARY KEY "
+        if self.is_not_null:
+            execute_str += "NOT NULL "
+        if self.is_unique:
+            execute_str += "UNIQUE "
+        if self.default is not None:
+            execute_str += "DEFAULT {} ".format(self.get_default_literal())
+        return execute_str
+
+
+class IndexDeclarer(object):
+    def __init__(self, index_name: str, columns: List[str], is_unique: bool = False, where: Optional[str] = None) -> None:
+        self.index_name = index_name
+        self.columns = columns
+        self.is_unique = is_unique
+        self.where = where
+
+    def get_creation_cmd(self, table_name: str):
+        """
+        Returns the SQL string for creating the index, in the form SQLite keeps in `sqlite_master`.
+        """
+        execute_str = "CREATE {}INDEX {} ON {} ({})".format(
+            "UNIQUE " if self.is_unique else "",
+            self.index_name,
+            table_name,
+            ",".join(self.columns),
+        )
+        if self.where:
+            execute_str += " WHERE {}".format(self.where)
+        return execute_str
+
 
 class TableDeclarer(object):
     def __init__(self) -> None:
         self.table_name = ""
         self.columns: Dict[str, ColumnDeclarer] = dict()
         self.pkey_count = 0
+        self.indexes: Dict[str, IndexDeclarer] = dict()
 
     def set_table_name(self, table_name):
         self.table_name = table_name
@@ -57,6 +128,31 @@ class TableDeclarer(object):
         self.columns[column_name] = ColumnDeclarer(column_name, column_type, is_primary, is_not_null, is_unique, default)
         return self
 
+    def declare_index(self, *columns: str, index_name: Optional[str] = None, is_unique: bool = False, where: Optional[str] = None):
+        """
+        Declare a secondary index on the columns, in order. `where` makes it a partial index, e.g. `"deleted = 0"`.
+        The default name is `idx_{table}_{columns}`.
+        """
+        if len(columns) == 0:
+            raise NoColumnException("No column declared for index of table {}".format(self.table_name))
+        if index_name is None:
+            index_name = "idx_{}_{}".format(self.table_name, "_".join(columns))
+        self.indexes[index_name] = IndexDeclarer(index_name, list(columns), is_unique, where)
+        return self
+
+    def get_index_creation_cmds(self) -> List[str]:
+        """
+        Returns the SQL strings for creating the declared indexes.
+
+        Raises:
+            NoColumnException: If an index uses a column that is not declared.
+        """
+        for index in self.indexes.values():
+            for column in index.columns:
+                if column not in self.columns:
+                    raise NoColumnException("Index {} uses undeclared column {}".format(index.index_name, column))
+        return [index.get_creation_cmd(self.table_name) + ";" for index in self.indexes.values()]
+
     def get_creation_cmd(self):
         """
         Returns the SQL string for creating the table based on the specified table name and columns.
@@ -74,19 +170,7 @@ class TableDeclarer(object):
             raise NoColumnException("No column declared: {}".format(self.table_name))
         execute_str = "CREATE TABLE {} (".format(self.table_name)
         for column in self.columns.values():
-            execute_str += "\n{} {} ".format(column.column_name, column.column_type)
-            if column.is_primary and self.pkey_count == 1:
-                execute_str += "PRIMARY KEY "
-            if column.is_not_null:
-                execute_str += "NOT NULL "
-            if column.is_unique:
-                execute_str += "UNIQUE "
-            if column.default is not None:
-                if column.column_type == TEXT:
-                    execute_str += "DEFAULT '{}' ".format(column.default)
-                else:
-                    execute_str += "DEFAULT {} ".format(column.default)
-            execute_str += ","
+            execute_str += "\n" + column.get_definition(self.pkey_count == 1) + ","
         if self.pkey_count > 1:
             execute_str = execute_str + "\nPRIMARY KEY ("
             for column in self.columns.values():
@@ -141,6 +225,40 @@ class DbDeclarer(object):
         self.tables[table_name] = t.set_table_name(table_name)
         return t
 
+    def get_schema_version(self) -> int:
+        """
+        A fingerprint of the declared schema, recorded in `SCHEMA_META_TABLE` once the database matches it.
+        """
+        commands: List[str] = []
+        for table_name in sorted(self.tables):
+            table = self.tables[table_name]
+            commands.append(table.get_creation_cmd())
+            commands.extend(table.get_index_creation_cmds())
+        return zlib.crc32("\n".join(commands).encode("utf-8"))
+
+    @staticmethod
+    async def _get_recorded_schema_version(c: aiosqlite.Cursor) -> Optional[int]:
+        await c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (SCHEMA_META_TABLE,))
+        if await c.fetchone() is None:
+            return None
+        await c.execute("SELECT value FROM {} WHERE name=?".format(SCHEMA_META_TABLE), (SCHEMA_FINGERPRINT_KEY,))
+        row = await c.fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    async def _record_schema_version(c: aiosqlite.Cursor, schema_version: int) -> None:
+        await c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (SCHEMA_META_TABLE,))
+        if await c.fetchone() is None:
+            command = (
+                TableDeclarer()
+                .set_table_name(SCHEMA_META_TABLE)
+                .declare_col("name", TEXT, is_primary=True)
+                .declare_col("value", INT, is_not_null=True)
+                .get_creation_cmd()
+            )
+            await c.execute(command)
+        await c.execute("INSERT OR REPLACE INTO {} (name, value) VALUES (?, ?)".format(SCHEMA_META_TABLE), (SCHEMA_FINGERPRINT_KEY, schema_version))
+
     async def create_or_validate(self):
         if os.path.exists(self.db_path):
             await self.validate()
@@ -166,23 +284,169 @@ class DbDeclarer(object):
                 command = table.get_creation_cmd()
                 _LOGGER.warning(command)
                 await c.execute(command)
+                for command in table.get_index_creation_cmds():
+                    _LOGGER.warning(command)
+                    await c.execute(command)
+            await self._record_schema_version(c, self.get_schema_version())
             await conn.commit()
             await conn.close()
         except Exception as e:
             raise DbCreationException from e
 
     async def validate(self):
-        # check if table exists
+        """
+        Create missing tables and indexes, and migrate existing tables to the declared columns without losing data.
+        Skipped if the recorded schema version matches the declaration.
+        """
         conn = await aiosqlite.connect(self.db_path)
-        c = await conn.cursor()
-        for table in self.tables.values():
-            command = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}'".format(table.table_name)
-            _LOGGER.debug(command)
+        try:
+            c = await conn.cursor()
+            schema_version = self.get_schema_version()
+            if await self._get_recorded_schema_version(c) == schema_version:
+                _LOGGER.debug("Schema of %s is up to date", self.db_path)
+                return
+            await c.execute(TABLE_COLUMNS_QUERY)
+            # table name -> [(cid, name, type, notnull, dflt_value, pk), ...]
+            existing_tables: Dict[str, List[Any]] = {}
+            for row in await c.fetchall():
+                existing_tables.setdefault(row[0], []).append(tuple(row[1:]))
+            for table in self.tables.values():
+                if table.table_name not in existing_tables:
+                    _LOGGER.warning("Table %s not exists", table.table_name)
+                    command = table.get_creation_cmd()
+                    _LOGGER.warning(command)
+                    await c.execute(command)
+                else:
+                    await self._migrate_table(conn, c, table, existing_tables[table.table_name])
+            # read after the migrations, rebuilt tables lose their indexes
+            await c.execute("SELECT name, sql FROM sqlite_master WHERE type='index'")
+            existing_indexes: Dict[str, Optional[str]] = {row[0]: row[1] for row in await c.fetchall()}
+            for table in self.tables.values():
+                await self._validate_indexes(c, table, existing_indexes)
+            await self._record_schema_version(c, schema_version)
+            await conn.commit()
+        finally:
+            await conn.close()
+
+    @classmethod
+    async def _migrate_table(cls, conn: aiosqlite.Connection, c: aiosqlite.Cursor, table: TableDeclarer, table_info: List[Any]):
+        """
+        Diff the declared columns with the `PRAGMA table_info` rows and the UNIQUE constraints. New columns that
+        SQLite can add in place are added with `ALTER TABLE`, other changes rebuild the table. Undeclared columns are kept.
+        """
+        # name -> (cid, name, type, notnull, dflt_value, pk)
+        existing = {row[1]: row for row in table_info}
+        await c.execute(UNIQUE_COLUMNS_QUERY, (table.table_name,))
+        unique_columns = {row[0] for row in await c.fetchall()}
+        to_add: List[ColumnDeclarer] = []
+        need_rebuild = False
+        for column in table.columns.values():
+            row = existing.get(column.column_name)
+            if row is None:
+                if column.is_primary or column.is_unique or (column.is_not_null and column.default is None):
+                    need_rebuild = True
+                else:
+                    to_add.append(column)
+            elif not column.matches(row, unique_columns):
+                _LOGGER.warning("Column %s of table %s changed", column.column_name, table.table_name)
+                need_rebuild = True
+        extra_columns = [name for name in existing if name not in table.columns]
+        if extra_columns:
+            _LOGGER.warning("Columns %s of table %s are not declared, kept as they are", extra_columns, table.table_name)
+        if need_rebuild:
+            await cls._rebuild_table(conn, c, table, existing, extra_columns)
+            return
+        for column in to_add:
+            command = "ALTER TABLE {} ADD COLUMN {}".format(table.table_name, column.get_definition(False).rstrip())
+            _LOGGER.warning(command)
             await c.execute(command)
-            if not await c.fetchone():
-                _LOGGER.warning("Table %s not exists", table.table_name)
-                command = table.get_creation_cmd()
+
+    @staticmethod
+    async def _rebuild_table(conn: aiosqlite.Connection, c: aiosqlite.Cursor, table: TableDeclarer, existing: Dict[str, Any], extra_columns: List[str]):
+        """
+        Copy the table into a new one with the declared columns, `MIGRATION_CHUNK_SIZE` rows at a time,
+        then swap them. The copy and the swap run in one `BEGIN IMMEDIATE` transaction, so other writers
+        wait for the migration instead of writing rows that would be lost, and a failure leaves the table as it was.
+        NULLs of a column which became NOT NULL are replaced by its default.
+        Undeclared indexes and the triggers of the table are created again on the new table.
+        """
+        table_name = table.table_name
+        for column in table.columns.values():
+            if column.column_name not in existing and column.is_not_null and column.default is None:
+                raise DbCreationException("Cannot add NOT NULL column {} without default to table {}".format(column.column_name, table_name))
+        new_table = TableDeclarer().set_table_name(table_name + "__migrating")
+        for column in table.columns.values():
+            new_table.declare_col(column.column_name, column.column_type, column.is_primary, column.is_not_null, column.is_unique, column.default)
+        for name in extra_columns:
+            new_table.declare_col(name, existing[name][2])
+        copied_columns = [name for name in new_table.columns if name in existing]
+        selected_columns = []
+        for name in copied_columns:
+            column = new_table.columns[name]
+            if column.is_not_null and column.default is not None:
+                selected_columns.append("COALESCE({}, {})".format(name, column.get_default_literal()))
+            else:
+                selected_columns.append(name)
+        copy_command = "INSERT INTO {} ({}) SELECT {} FROM {} WHERE rowid > ? AND rowid <= ?".format(
+            new_table.table_name, ",".join(copied_columns), ",".join(selected_columns), table_name
+        )
+
+        await conn.commit()
+        await c.execute("BEGIN IMMEDIATE")
+        try:
+            # left by a migration interrupted before this transaction was used
+            await c.execute("DROP TABLE IF EXISTS {}".format(new_table.table_name))
+            # dropped with the table. declared indexes are created by `_validate_indexes`, constraint indexes have no sql
+            await c.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name=? AND type IN ('index', 'trigger') AND sql IS NOT NULL", (table_name,))
+            to_recreate = [tuple(row) for row in await c.fetchall() if row[1] not in table.indexes]
+            command = new_table.get_creation_cmd()
+            _LOGGER.warning(command)
+            await c.execute(command)
+            last_rowid = -(1 << 63)
+            copied = 0
+            while True:
+                await c.execute(
+                    "SELECT MAX(rowid), COUNT(*) FROM (SELECT rowid FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?)".format(table_name),
+                    (last_rowid, MIGRATION_CHUNK_SIZE),
+                )
+                row = await c.fetchone()
+                if row is None or row[1] == 0:
+                    break
+                await c.execute(copy_command, (last_rowid, row[0]))
+                last_rowid = row[0]
+                copied += row[1]
+                _LOGGER.info("Rebuilding table %s: %d rows copied", table_name, copied)
+                await asyncio.sleep(0)
+            await c.execute("DROP TABLE {}".format(table_name))
+            await c.execute("ALTER TABLE {} RENAME TO {}".format(new_table.table_name, table_name))
+            for kind, name, command in to_recreate:
                 _LOGGER.warning(command)
-                await c.execute(command)
+                try:
+                    await c.execute(command)
+                except sqlite3.Error as e:
+                    _LOGGER.error("Cannot recreate %s %s of table %s, dropped: %s", kind, name, table_name, e)
+        except BaseException:
+            await conn.rollback()
+            raise
         await conn.commit()
-        await conn.close()
+        _LOGGER.warning("Table %s rebuilt, %d rows copied", table_name, copied)
+
+    @staticmethod
+    async def _validate_indexes(c: aiosqlite.Cursor, table: TableDeclarer, existing_indexes: Dict[str, Optional[str]]):
+        """
+        create missing indexes, and rebuild the ones whose definition changed.
+        `existing_indexes` maps index names to their sql in `sqlite_master`.
+        """
+        for index in table.indexes.values():
+            command = index.get_creation_cmd(table.table_name)
+            if existing_indexes.get(index.index_name) == command:
+                continue
+            if index.index_name in existing_indexes:
+                _LOGGER.warning("Index %s changed, rebuilding", index.index_name)
+                drop_command = "DROP INDEX {}".format(index.index_name)
+                _LOGGER.warning(drop_command)
+                await c.execute(drop_command)
+            else:
+                _LOGGER.warning("Index %s not exists", index.index_name)
+            _LOGGER.warning(command)
+            await c.execute(command)
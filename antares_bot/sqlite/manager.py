@@ -1,14 +1,22 @@
 import asyncio
+import itertools
+import logging
+import pathlib
+import sqlite3
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from types import TracebackType
-from typing import Any, Literal, Optional, cast
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable, Literal, Optional, TypeVar, cast
 
 import aiosqlite
 
 from antares_bot.bot_logging import get_logger
-from antares_bot.sqlite.creater import TableDeclarer
+from antares_bot.sqlite.creater import TABLE_COLUMNS_QUERY, TableDeclarer
+from antares_bot.sqlite.worker_pool import SqliteWorkerPool, call_on_thread
 
 
 SqlRowDict = dict[str, Any]
+_T = TypeVar("_T")
 _LOGGER = get_logger(__name__)
 
 
@@ -24,8 +32,41 @@ UPDATE_COMMAND_FORMAT = """UPDATE {table} SET {set}"""
 DELETE_COMMAND_FORMAT = "DELETE FROM {table}"
 WHERE_PART_FORMAT = """ WHERE {where}"""
 
+# pragmas of the pooled mode. WAL lets readers run concurrently with the writer
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA temp_store=MEMORY;",
+)
+READER_PRAGMAS = (
+    "PRAGMA query_only=ON;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA temp_store=MEMORY;",
+)
+# writes committed together in write-behind mode, unless the delay elapses first
+WRITE_BEHIND_DEFAULT_BATCH = 1000
+# rows passed to each `executemany` by the bulk insert
+BULK_INSERT_CHUNK_SIZE = 1000
+BULK_INSERT_SAVEPOINT = "antares_bulk_insert"
+BULK_INSERT_CHUNK_SAVEPOINT = "antares_bulk_insert_chunk"
+BATCH_SAVEPOINT = "antares_batch"
+# rows fetched at a time by `iter_select`
+SELECT_ITER_BATCH_SIZE = 500
+# max number of bound parameters in one statement of `TableProxy.aget_many`, under SQLITE_MAX_VARIABLE_NUMBER
+IN_QUERY_MAX_PARAMS = 900
+# default size of `TableProxy.enable_row_cache`
+ROW_CACHE_DEFAULT_SIZE = 1024
+# the statement cache is cleared when it grows above this size
+STATEMENT_CACHE_MAX_SIZE = 1024
+
 
 class DataBasesManager:
+    """
+    Keeps the opened databases, to close them at shutdown.
+    With `enable_shared_workers`, the connections of all databases share a small pool of threads,
+    instead of one thread per connection.
+    """
     INST: "DataBasesManager" = None  # type: ignore
 
     @classmethod
@@ -36,6 +77,29 @@ class DataBasesManager:
 
     def __init__(self) -> None:
         self._registered_databases: dict[str, Database] = {}
+        self._worker_pool: SqliteWorkerPool | None = None
+
+    def enable_shared_workers(self, threads: int) -> None:
+        """
+        run the connections opened from now on over `threads` shared threads.
+        """
+        if self._worker_pool is not None:
+            raise RuntimeError("Shared sqlite workers already enabled")
+        self._worker_pool = SqliteWorkerPool(threads)
+
+    def connect(self, database: str, **kwargs: Any) -> aiosqlite.Connection:
+        """
+        same as `aiosqlite.connect`, on the shared workers if enabled.
+        """
+        if self._worker_pool is not None:
+            return self._worker_pool.connect(database, **kwargs)
+        return aiosqlite.connect(database, **kwargs)
+
+    def worker_stats(self) -> dict[str, Any] | None:
+        """
+        thread count and queue latency of the shared workers, None if not enabled.
+        """
+        return None if self._worker_pool is None else self._worker_pool.stats()
 
     async def shutdown(self):
         databases = self._registered_databases
@@ -43,6 +107,9 @@ class DataBasesManager:
         task = asyncio.gather(*(db.close() for db in databases.values()))
         await task
         _LOGGER.info("Closed %d databases", len(databases))
+        if self._worker_pool is not None:
+            self._worker_pool.shutdown()
+            self._worker_pool = None
 
     def register_database(self, name: str, db: "Database"):
         self._registered_databases[name] = db
@@ -52,11 +119,26 @@ class DataBasesManager:
 
 
 class TableProxy(TableDeclarer):
+    """
+    Access rows of a table by primary key.
+
+    `enable_row_cache` adds a bounded LRU cache of rows (and of missing rows) by primary key.
+    It is filled by `aget`/`agetitem`, written through by `aset`, and invalidated by the
+    insert, update and delete paths of `Database`. `execute` and `run_batch` clear it.
+    Writes made outside of `Database` are not seen by the cache.
+    """
+
     def __init__(self, db: "Database", table_name: str) -> None:
         super().__init__()
         self.db = db
         self.table_name = table_name
         self.primary_keys: list[str] = []
+        self.row_cache: OrderedDict[tuple, SqlRowDict | None] | None = None
+        self.row_cache_size = 0
+        # bumped by every invalidation, so that a read racing with a write does not fill the cache
+        self.row_cache_gen = 0
+        self.row_cache_hits = 0
+        self.row_cache_misses = 0
 
     def declare_col(self, column_name: str, column_type: str, is_primary: bool = False, is_not_null: bool = False, is_unique: bool = False, default: Any = None):
         super().declare_col(column_name, column_type, is_primary, is_not_null, is_unique, default)
@@ -72,12 +154,70 @@ class TableProxy(TableDeclarer):
             where = {self.primary_keys[0]: pk_data}
         return where
 
+    def enable_row_cache(self, max_size: int = ROW_CACHE_DEFAULT_SIZE) -> None:
+        """
+        cache up to `max_size` rows. the setting survives `Database.update_table_info`.
+        """
+        self.db.row_cache_sizes[self.table_name] = max_size
+        self.row_cache_size = max_size
+        if self.row_cache is None:
+            self.row_cache = OrderedDict()
+        while len(self.row_cache) > max_size:
+            self.row_cache.popitem(last=False)
+
+    def row_cache_stats(self) -> dict[str, Any]:
+        total = self.row_cache_hits + self.row_cache_misses
+        return {
+            "size": 0 if self.row_cache is None else len(self.row_cache),
+            "hits": self.row_cache_hits,
+            "misses": self.row_cache_misses,
+            "hit_rate": self.row_cache_hits / total if total else 0.,
+        }
+
+    def _cache_put(self, key: tuple, value: SqlRowDict | None) -> None:
+        cache = cast(OrderedDict, self.row_cache)
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.row_cache_size:
+            cache.popitem(last=False)
+
+    def invalidate_rows(self, rows: Iterable[SqlRowDict] | None = None) -> None:
+        """
+        drop the cached rows with the primary keys found in `rows`. drop all if `rows` is None,
+        or if a row lacks a primary key column.
+        """
+        if self.row_cache is None:
+            return
+        self.row_cache_gen += 1
+        if rows is None:
+            self.row_cache.clear()
+            return
+        for row in rows:
+            try:
+                self.row_cache.pop(tuple(row[k] for k in self.primary_keys), None)
+            except KeyError:
+                self.row_cache.clear()
+                return
+
     async def _aget_internal(self, select_interface, where):
+        cache = self.row_cache
+        snapshot: tuple[int, int] | None = None
+        if cache is not None:
+            key = tuple(where.values())
+            if key in cache:
+                self.row_cache_hits += 1
+                cache.move_to_end(key)
+                value = cache[key]
+                return value is not None, None if value is None else value.copy()
+            self.row_cache_misses += 1
+            snapshot = (self.row_cache_gen, self.db.commit_gen)
         rows = await select_interface(self.table_name, where=where)
         rows_list = [dict(row) for row in rows]
         if len(rows_list) > 1:
             raise RuntimeError("More than one row found")
         found = bool(rows_list)
+        if cache is not None and self.row_cache is cache and snapshot == (self.row_cache_gen, self.db.commit_gen) and not self.db.has_pending_writes:
+            self._cache_put(key, rows_list[0].copy() if found else None)
         return found, rows_list[0] if found else None
 
     async def aget(self, pk_data: tuple | Any):
@@ -94,6 +234,111 @@ class TableProxy(TableDeclarer):
     def __getitem__(self, pk_data: tuple | Any):
         return self.agetitem(pk_data)
 
+    def _normalize_pk(self, pk_data: tuple | Any) -> Any:
+        if len(self.primary_keys) == 1:
+            return pk_data[0] if isinstance(pk_data, tuple) else pk_data
+        if not isinstance(pk_data, tuple) or len(pk_data) != len(self.primary_keys):
+            raise ValueError("Primary key length not match")
+        return pk_data
+
+    def _get_in_commands(self, pk_list: list[Any]) -> list[tuple[str, list]]:
+        """
+        `WHERE pk IN (...)` queries for the keys, `WHERE (pk1, pk2) IN (VALUES (...), ...)` for composite keys,
+        chunked under the parameter limit.
+        """
+        pk_count = len(self.primary_keys)
+        chunk_size = max(1, IN_QUERY_MAX_PARAMS // pk_count)
+        commands = []
+        for i in range(0, len(pk_list), chunk_size):
+            chunk = pk_list[i:i + chunk_size]
+            if pk_count == 1:
+                command = self.db.cached_statement(
+                    ("select_in", self.table_name, len(chunk)),
+                    lambda n=len(chunk): f"SELECT * FROM {self.table_name} WHERE {self.primary_keys[0]} IN ({','.join('?' * n)});",
+                )
+                commands.append((command, chunk))
+            else:
+                one_value = "(" + ",".join("?" * pk_count) + ")"
+                command = self.db.cached_statement(
+                    ("select_in", self.table_name, len(chunk)),
+                    lambda n=len(chunk), one_value=one_value: (
+                        f"SELECT * FROM {self.table_name} WHERE ({','.join(self.primary_keys)}) IN (VALUES {','.join([one_value] * n)});"
+                    ),
+                )
+                commands.append((command, [v for pk in chunk for v in pk]))
+        return commands
+
+    def _fetch_rows_on_thread(self, conn: sqlite3.Connection, commands: list[tuple[str, list]]) -> dict[Any, SqlRowDict]:
+        ret = {}
+        for command, args in commands:
+            for row in conn.execute(command, args):
+                row_dict = dict(row)
+                ret[self._row_pk(row_dict)] = row_dict
+        return ret
+
+    def _row_pk(self, row: SqlRowDict) -> Any:
+        if len(self.primary_keys) == 1:
+            return row[self.primary_keys[0]]
+        return tuple(row[k] for k in self.primary_keys)
+
+    def _aget_many_from_cache(self, pk_list: list[Any]) -> tuple[dict[Any, SqlRowDict], list[Any]]:
+        found: dict[Any, SqlRowDict] = {}
+        if self.row_cache is None:
+            return found, pk_list
+        missing = []
+        for pk in pk_list:
+            key = pk if isinstance(pk, tuple) else (pk,)
+            if key in self.row_cache:
+                self.row_cache_hits += 1
+                self.row_cache.move_to_end(key)
+                value = self.row_cache[key]
+                if value is not None:
+                    found[pk] = value.copy()
+            else:
+                self.row_cache_misses += 1
+                missing.append(pk)
+        return found, missing
+
+    def _fill_cache(self, snapshot: tuple[int, int], rows: dict[Any, SqlRowDict]) -> None:
+        # keyed by the stored primary keys, which may differ in type from the requested ones
+        if self.row_cache is None or snapshot != (self.row_cache_gen, self.db.commit_gen) or self.db.has_pending_writes:
+            return
+        for pk, row in rows.items():
+            self._cache_put(pk if isinstance(pk, tuple) else (pk,), row.copy())
+
+    async def aget_many(self, pk_datas: Iterable[tuple | Any]) -> dict[Any, SqlRowDict]:
+        """
+        get the rows of many primary keys in one round trip. return a dict from primary key
+        (a tuple for composite keys) to row; missing keys are left out.
+        """
+        pk_list = list(dict.fromkeys(self._normalize_pk(pk) for pk in pk_datas))
+        ret, missing = self._aget_many_from_cache(pk_list)
+        if not missing:
+            return ret
+        snapshot = (self.row_cache_gen, self.db.commit_gen)
+        rows = await self.db.run_read(self._fetch_rows_on_thread, self._get_in_commands(missing))
+        self._fill_cache(snapshot, rows)
+        ret.update(rows)
+        return ret
+
+    async def aget_many_nolock(self, pk_datas: Iterable[tuple | Any]) -> dict[Any, SqlRowDict]:
+        pk_list = list(dict.fromkeys(self._normalize_pk(pk) for pk in pk_datas))
+        ret, missing = self._aget_many_from_cache(pk_list)
+        if not missing:
+            return ret
+        snapshot = (self.row_cache_gen, self.db.commit_gen)
+        rows: dict[Any, SqlRowDict] = {}
+        for command, args in self._get_in_commands(missing):
+            _LOGGER.debug("execute command %s with args: %s", command, args)
+            self.db.last_command_and_args = (command, args)
+            await self.db.cursor.execute(command, args)
+            for row in await self.db.cursor.fetchall():
+                row_dict = dict(row)
+                rows[self._row_pk(row_dict)] = row_dict
+        self._fill_cache(snapshot, rows)
+        ret.update(rows)
+        return ret
+
     async def aget_nolock(self, pk_data: tuple | Any):
         where = self._get_parsed_where(pk_data)
         _, value = await self._aget_internal(self.db.select_nolock, where)
@@ -118,34 +363,111 @@ class TableProxy(TableDeclarer):
     async def _aset_internal(self, insert_interface, insert_value: SqlRowDict):
         return await insert_interface(self.table_name, insert_value)
 
-    async def aset(self, pk_data: tuple | Any, value: SqlRowDict):
+    def _write_through(self, insert_value: SqlRowDict) -> None:
+        # a partial row is left to the next read
+        if self.row_cache is not None and insert_value.keys() == self.columns.keys():
+            self._cache_put(tuple(insert_value[k] for k in self.primary_keys), insert_value.copy())
+
+    async def aset(self, pk_data: tuple | Any, value: SqlRowDict, durable: bool = False):
         insert_value = self._get_parsed_data_dicts(pk_data, value)
-        return await self._aset_internal(self.db.insert, insert_value)
+        await self._aset_internal(self.db.insert, insert_value)
+        self._write_through(insert_value)
+        if durable:
+            await self.db.wait_durable()
 
     async def aset_nolock(self, pk_data: tuple | Any, value: SqlRowDict):
         insert_value = self._get_parsed_data_dicts(pk_data, value)
-        return await self._aset_internal(self.db.insert_nolock, insert_value)
+        await self._aset_internal(self.db.insert_nolock, insert_value)
+        self._write_through(insert_value)
 
 
 class Database(object):
-    def __init__(self, dbpath: str) -> None:
+    """
+    With `readers > 0`, the database runs in pooled mode: the connection becomes the only writer,
+    the database is switched to WAL, and `readers` read-only connections serve `select`
+    (and so `TableProxy.aget`) without taking the lock, concurrently with the writer.
+    Mutating calls and the `*_nolock` methods keep using the writer.
+
+    With `write_behind` set to a delay in seconds, the database runs in write-behind mode:
+    mutations of many coroutines are collected into one transaction, committed when
+    `write_behind_batch` writes are pending or `write_behind` seconds after the first one.
+    Callers that need their write on disk pass `durable=True`, or await `wait_durable()`.
+    In pooled mode, readers do not see pending writes.
+    """
+
+    def __init__(self, dbpath: str, readers: int = 0, write_behind: float | None = None, write_behind_batch: int = WRITE_BEHIND_DEFAULT_BATCH) -> None:
         self.db_path = dbpath
         self.conn: aiosqlite.Connection | None = None
+        self.readers = readers
+        self.write_behind = write_behind
+        self.write_behind_batch = write_behind_batch
+        self._pending_writes = 0
+        self._commit_waiters: list[asyncio.Future[None]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._reader_pool: asyncio.Queue[aiosqlite.Connection] | None = None
         self.lock = asyncio.Lock()
         self.table_info: dict[str, TableProxy] | None = None  # table name -> [(column name, type), ...]
         self.dirty_mark = False
         self._cursor = None
-        self._last_command_and_args: tuple[str, Any] | None = None
+        # the statement logged when a locked block fails
+        self.last_command_and_args: tuple[str, Any] | None = None
+        # (operation, table, columns, where keys) -> sql
+        self._statement_cache: dict[tuple, str] = {}
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        # commands already checked by `_explain_query_plan`
+        self._explained_commands: set[str] = set()
+        # table name -> row cache size, see `TableProxy.enable_row_cache`
+        self.row_cache_sizes: dict[str, int] = {}
+        # bumped after every commit
+        self._commit_gen = 0
+        # (schema_version, table name -> table_info rows) of the last `update_table_info`
+        self._schema_cache: tuple[int, dict[str, list[sqlite3.Row]]] | None = None
 
     async def connect(self) -> None:
         await self.close()
-        self.conn = await aiosqlite.connect(self.db_path)
+        self.conn = await DataBasesManager.get_inst().connect(self.db_path)
         self.conn.row_factory = aiosqlite.Row
+        if self.readers > 0:
+            await self._connect_readers()
         DataBasesManager.get_inst().register_database(self.db_path, self)
         await self.update_table_info()
 
+    async def _connect_readers(self) -> None:
+        for pragma in WRITER_PRAGMAS:
+            await self.get_cur_connection().execute(pragma)
+        uri = pathlib.Path(self.db_path).absolute().as_uri() + "?mode=ro"
+        self._reader_pool = asyncio.Queue()
+        for _ in range(self.readers):
+            reader = await DataBasesManager.get_inst().connect(uri, uri=True)
+            reader.row_factory = aiosqlite.Row
+            for pragma in READER_PRAGMAS:
+                await reader.execute(pragma)
+            self._reader_conns.append(reader)
+            self._reader_pool.put_nowait(reader)
+
     async def close(self) -> None:
         DataBasesManager.get_inst().remove_database(self.db_path)
+        flush_task = self._flush_task
+        self._flush_task = None
+        if flush_task is not None:
+            # still sleeping, a commit it started is shielded
+            flush_task.cancel()
+            await asyncio.wait([flush_task])
+        if self.conn is not None:
+            # the lock also waits for a group commit in progress
+            async with self.lock:
+                if self._pending_writes > 0:
+                    await self._commit_pending()
+        readers = self._reader_conns
+        self._reader_conns = []
+        self._reader_pool = None
+        for reader in readers:
+            try:
+                await reader.close()
+            except Exception:
+                ...
         if self.conn is not None:
             try:
                 await self.conn.close()
@@ -160,16 +482,41 @@ class Database(object):
     def cursor(self) -> aiosqlite.Cursor:
         return cast(aiosqlite.Cursor, self._cursor)
 
+    @property
+    def commit_gen(self) -> int:
+        """
+        bumped after every commit, row caches compare it before storing a read.
+        """
+        return self._commit_gen
+
+    @property
+    def has_pending_writes(self) -> bool:
+        """
+        whether write-behind writes are waiting for their commit.
+        """
+        return self._pending_writes > 0
+
     async def update_table_info(self) -> None:
+        """
+        read the columns of all tables in one query. skipped if the schema cookie did not change since the last call.
+        """
         # self.cursor maybe None here
         c = await self.get_cur_connection().cursor()
-        tables_info = await (await c.execute("select name from sqlite_master where type='table';")).fetchall()
-        tables_key: list[str] = [t[0] for t in tables_info]
+        schema_version = (await (await c.execute("PRAGMA schema_version;")).fetchone())[0]  # type: ignore
+        if self._schema_cache is not None and self._schema_cache[0] == schema_version:
+            tables = self._schema_cache[1]
+        else:
+            tables = {}
+            for row in await (await c.execute(TABLE_COLUMNS_QUERY)).fetchall():
+                tables.setdefault(row['table_name'], []).append(row)
+            self._schema_cache = (schema_version, tables)
         self.table_info = dict()
-        for table_name in tables_key:
-            table_info = await (await c.execute(f"PRAGMA table_info({table_name});")).fetchall()
+        self._statement_cache.clear()  # upserts depend on the primary keys
+        for table_name, table_info in tables.items():
             tb_declare = TableProxy(self, table_name)
             self.table_info[table_name] = tb_declare
+            if table_name in self.row_cache_sizes:
+                tb_declare.enable_row_cache(self.row_cache_sizes[table_name])
             for row in table_info:
                 tb_declare.declare_col(
                     row['name'],
@@ -179,52 +526,115 @@ class Database(object):
                     default=row['dflt_value'],
                 )
 
+    def _invalidate_rows(self, table: str, rows: Iterable[SqlRowDict] | None = None) -> None:
+        if self.table_info is not None and table in self.table_info:
+            self.table_info[table].invalidate_rows(rows)
+
+    def _invalidate_where(self, table: str, where: SqlRowDict | None, changed_columns: Iterable[str] = ()) -> None:
+        """
+        invalidate the row matched by a primary key `where`, or the whole table otherwise.
+        """
+        if self.table_info is None or table not in self.table_info:
+            return
+        proxy = self.table_info[table]
+        if where is not None and all(k in where and k not in changed_columns for k in proxy.primary_keys):
+            proxy.invalidate_rows([where])
+        else:
+            proxy.invalidate_rows()
+
+    def _invalidate_all_rows(self) -> None:
+        if self.table_info is not None:
+            for proxy in self.table_info.values():
+                proxy.invalidate_rows()
+
     def get_primary_key_names(self, table: str) -> list[str]:
         assert self.table_info is not None
         return self.table_info[table].primary_keys
 
+    def cached_statement(self, key: tuple, build: Callable[[], str]) -> str:
+        """
+        the sql cached under `key`, `build` makes it on a miss.
+        """
+        command = self._statement_cache.get(key)
+        if command is not None:
+            self.statement_cache_hits += 1
+            return command
+        self.statement_cache_misses += 1
+        if len(self._statement_cache) >= STATEMENT_CACHE_MAX_SIZE:
+            self._statement_cache.clear()
+        command = self._statement_cache[key] = build()
+        return command
+
+    def statement_cache_stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._statement_cache),
+            "hits": self.statement_cache_hits,
+            "misses": self.statement_cache_misses,
+        }
+
+    async def _explain_query_plan(self, conn: aiosqlite.Connection, command: str, parse_args: list) -> None:
+        """
+        debug mode only. warn once per statement if it scans a whole table instead of using an index.
+        """
+        if command in self._explained_commands:
+            return
+        if len(self._explained_commands) >= STATEMENT_CACHE_MAX_SIZE:
+            self._explained_commands.clear()
+        self._explained_commands.add(command)
+        try:
+            async with conn.execute("EXPLAIN QUERY PLAN " + command, parse_args) as cursor:
+                plan = await cursor.fetchall()
+        except Exception:
+            return
+        for row in plan:
+            detail: str = row[3]
+            if detail.startswith("SCAN ") and " USING " not in detail:
+                _LOGGER.warning("Query plan `%s` of command %s, consider declaring an index", detail, command)
+
     @staticmethod
-    def _key_eq_value_format(k, v, parse_arg: list):
-        parse_arg.append(v)
-        return f"{k}=?"
+    def _where_part(keys: Iterable[str]) -> str:
+        return WHERE_PART_FORMAT.format(where=" AND ".join(f"{k}=?" for k in keys))
+
+    def _get_select_command(self, table: str, where: SqlRowDict | None, need: list[str] | None) -> tuple[str, list]:
+        where_keys = tuple(where) if where else ()
+        columns = tuple(need) if need else ()
+
+        def build() -> str:
+            command = SELECT_COMMAND_FORMAT.format(
+                table=table,
+                columns=",".join(columns) if columns else "*"
+            )
+            if where_keys:
+                command += self._where_part(where_keys)
+            return command + ";"
+
+        command = self.cached_statement(("select", table, columns, where_keys), build)
+        return command, list(where.values()) if where else []
 
     async def select_nolock(
         self, table: str, where: SqlRowDict | None = None, need: list[str] | None = None
     ):
-        command = SELECT_COMMAND_FORMAT.format(
-            table=table,
-            columns=",".join(need) if need else "*"
-        )
-        parse_args: list = []
-        if where:
-            command += WHERE_PART_FORMAT.format(where=" AND ".join(
-                self._key_eq_value_format(k, v, parse_args) for k, v in where.items()
-            ))
-        command += ";"
+        command, parse_args = self._get_select_command(table, where, need)
 
         _LOGGER.debug("execute command %s with args: %s", command, parse_args)
-        self._last_command_and_args = (command, parse_args)
+        self.last_command_and_args = (command, parse_args)
+        if where and _LOGGER.isEnabledFor(logging.DEBUG):
+            await self._explain_query_plan(self.get_cur_connection(), command, parse_args)
 
         await self.cursor.execute(command, parse_args)
         return await self.cursor.fetchall()
 
-    async def insert_nolock(self, table: str, data_dicts: list[SqlRowDict] | SqlRowDict):
-        if not isinstance(data_dicts, list):
-            data_dicts = [data_dicts]
-        if len(data_dicts) == 0:
-            return
-
-        # do column name check
-        columns = list(data_dicts[0].keys())
-        columns_set = set(columns)
-        for i in range(1, len(data_dicts)):
-            if set(data_dicts[i].keys()) != columns_set:
-                raise ValueError("Column name not match")
+    def _get_insert_command(self, table: str, columns: list[str], rows_count: int) -> str:
+        return self.cached_statement(
+            ("insert", table, tuple(columns), rows_count),
+            lambda: self._build_insert_command(table, columns, rows_count),
+        )
 
+    def _build_insert_command(self, table: str, columns: list[str], rows_count: int) -> str:
         pks = self.get_primary_key_names(table)
 
         one_value = "(" + ",".join(["?" for _ in columns]) + ")"
-        many_values = ",\n".join([one_value for _ in data_dicts])
+        many_values = ",\n".join([one_value for _ in range(rows_count)])
 
         insert_command = INSERT_COMMAND_FORMAT.format(
             table=table,
@@ -238,16 +648,119 @@ class Database(object):
                 upsert_args=upsert_args,
             )
         insert_command += ";"
+        return insert_command
 
-        parse_args:list[Any] = []
-        for data_dict in data_dicts:
-            parse_args.extend(data_dict[col] for col in columns)
+    async def insert_nolock(self, table: str, data_dicts: list[SqlRowDict] | SqlRowDict):
+        if not isinstance(data_dicts, list):
+            data_dicts = [data_dicts]
+        if len(data_dicts) == 0:
+            return
+        if len(data_dicts) > 1:
+            await self.insert_many_nolock(table, data_dicts)
+            return
+
+        columns = list(data_dicts[0].keys())
+        insert_command = self._get_insert_command(table, columns, 1)
+        parse_args = [data_dicts[0][col] for col in columns]
 
         _LOGGER.debug("execute command %s with args: %s", insert_command, parse_args)
-        self._last_command_and_args = (insert_command, parse_args)
+        self.last_command_and_args = (insert_command, parse_args)
 
         await self.cursor.execute(insert_command, parse_args)
         self.dirty_mark = True
+        self._invalidate_rows(table, data_dicts)
+
+    async def insert_many_nolock(
+        self,
+        table: str,
+        rows: Iterable[SqlRowDict] | AsyncIterable[SqlRowDict],
+        chunk_size: int = BULK_INSERT_CHUNK_SIZE,
+    ) -> int:
+        """
+        insert (or upsert) rows with one single row statement and `executemany`, `chunk_size` rows at a time.
+        rows are consumed lazily, so an iterator or async iterator of any length can be passed.
+        all rows must have the columns of the first one. return the number of rows.
+        the insert is atomic: if a row fails, none of the rows are kept.
+        """
+        began = not self.get_cur_connection().in_transaction
+        if began:
+            # so that releasing the savepoint does not commit, the rows are committed like any other write
+            await self.cursor.execute("BEGIN;")
+        await self.cursor.execute(f"SAVEPOINT {BULK_INSERT_SAVEPOINT};")
+        try:
+            count = await self._insert_many_in_savepoint(table, rows, chunk_size)
+        except BaseException:
+            await self.cursor.execute(f"ROLLBACK TO {BULK_INSERT_SAVEPOINT};")
+            await self.cursor.execute(f"RELEASE {BULK_INSERT_SAVEPOINT};")
+            if began:
+                await self.cursor.execute("ROLLBACK;")
+            raise
+        await self.cursor.execute(f"RELEASE {BULK_INSERT_SAVEPOINT};")
+        if began and count == 0:
+            # nothing to commit, do not leave the transaction open
+            await self.cursor.execute("ROLLBACK;")
+        return count
+
+    async def _insert_many_in_savepoint(
+        self,
+        table: str,
+        rows: Iterable[SqlRowDict] | AsyncIterable[SqlRowDict],
+        chunk_size: int,
+    ) -> int:
+        statement: tuple[str, list[str]] | None = None
+        count = 0
+        if isinstance(rows, AsyncIterable):
+            chunk: list[SqlRowDict] = []
+            async for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    statement = await self._insert_chunk_nolock(table, chunk, statement)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                await self._insert_chunk_nolock(table, chunk, statement)
+                count += len(chunk)
+            return count
+        it = iter(rows)
+        while chunk := list(itertools.islice(it, chunk_size)):
+            statement = await self._insert_chunk_nolock(table, chunk, statement)
+            count += len(chunk)
+        return count
+
+    async def _insert_chunk_nolock(self, table: str, chunk: list[SqlRowDict], statement: tuple[str, list[str]] | None) -> tuple[str, list[str]]:
+        if statement is None:
+            columns = list(chunk[0].keys())
+            statement = (self._get_insert_command(table, columns, 1), columns)
+        insert_command, columns = statement
+        columns_set = set(columns)
+        parse_args: list[tuple] = []
+        for row in chunk:
+            # do column name check
+            if row.keys() != columns_set:
+                raise ValueError("Column name not match")
+            parse_args.append(tuple(row[col] for col in columns))
+
+        _LOGGER.debug("execute command %s with %d rows", insert_command, len(parse_args))
+        self.last_command_and_args = (insert_command, parse_args[0])
+
+        # a savepoint per chunk, to find the failing row of `executemany` by replaying the chunk
+        await self.cursor.execute(f"SAVEPOINT {BULK_INSERT_CHUNK_SAVEPOINT};")
+        try:
+            await self.cursor.executemany(insert_command, parse_args)
+        except sqlite3.Error:
+            await self.cursor.execute(f"ROLLBACK TO {BULK_INSERT_CHUNK_SAVEPOINT};")
+            for args in parse_args:
+                try:
+                    await self.cursor.execute(insert_command, args)
+                except sqlite3.Error:
+                    self.last_command_and_args = (insert_command, args)
+                    break
+            # the replayed rows are dropped by the rollback of the whole insert
+            raise
+        await self.cursor.execute(f"RELEASE {BULK_INSERT_CHUNK_SAVEPOINT};")
+        self.dirty_mark = True
+        self._invalidate_rows(table, chunk)
+        return statement
 
     async def update_nolock(self, table: str, datadict: SqlRowDict, where: SqlRowDict | Literal["*"] | None = None):
         if where:
@@ -261,41 +774,66 @@ class Database(object):
             _LOGGER.debug("nothing to set, no need to update database")
             return
 
-        parse_args: list = []
-        command = UPDATE_COMMAND_FORMAT.format(
-            table=table,
-            set=",".join(self._key_eq_value_format(k, v, parse_args) for k, v in datadict.items()),
-        )
+        set_keys = tuple(datadict)
+        where_keys = None if where_data is None else tuple(where_data)
 
-        if where_data is not None:
-            command += WHERE_PART_FORMAT.format(where=" AND ".join(
-                self._key_eq_value_format(k, v, parse_args) for k, v in where_data.items()
-            ))
+        def build() -> str:
+            command = UPDATE_COMMAND_FORMAT.format(
+                table=table,
+                set=",".join(f"{k}=?" for k in set_keys),
+            )
+            if where_keys is not None:
+                command += self._where_part(where_keys)
+            return command + ";"
 
-        command += ";"
+        command = self.cached_statement(("update", table, set_keys, where_keys), build)
+        parse_args = list(datadict.values())
+        if where_data is not None:
+            parse_args.extend(where_data.values())
 
         _LOGGER.debug("parse command %s with args: %s", command, parse_args)
-        self._last_command_and_args = (command, parse_args)
+        self.last_command_and_args = (command, parse_args)
+        if where_data and _LOGGER.isEnabledFor(logging.DEBUG):
+            await self._explain_query_plan(self.get_cur_connection(), command, parse_args)
 
         await self.cursor.execute(command, parse_args)
         self.dirty_mark = True
+        self._invalidate_where(table, where_data, set_keys)
 
     async def delete_nolock(self, table: str, where: SqlRowDict | Literal["*"]):
-        command = DELETE_COMMAND_FORMAT.format(table=table)
-        parse_args: list = []
+        where_keys = None if where == "*" else tuple(where)
 
-        if where != "*":
-            command += WHERE_PART_FORMAT.format(where=" AND ".join([
-                self._key_eq_value_format(k, v, parse_args) for k, v in where.items()
-            ]))
+        def build() -> str:
+            command = DELETE_COMMAND_FORMAT.format(table=table)
+            if where_keys is not None:
+                command += self._where_part(where_keys)
+            return command + ";"
 
-        command += ";"
+        command = self.cached_statement(("delete", table, (), where_keys), build)
+        parse_args = [] if where == "*" else list(where.values())
 
         _LOGGER.debug("parse command %s with args: %s", command, parse_args)
-        self._last_command_and_args = (command, parse_args)
+        self.last_command_and_args = (command, parse_args)
+        if where != "*" and where and _LOGGER.isEnabledFor(logging.DEBUG):
+            await self._explain_query_plan(self.get_cur_connection(), command, parse_args)
 
         await self.cursor.execute(command, parse_args)
         self.dirty_mark = True
+        self._invalidate_where(table, None if where == "*" else where)
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        borrow a read-only connection in pooled mode.
+        """
+        if self._reader_pool is None:
+            raise RuntimeError("Database not connected in pooled mode")
+        pool = self._reader_pool
+        conn = await pool.get()
+        try:
+            yield conn
+        finally:
+            pool.put_nowait(conn)
 
     async def select(
         self,
@@ -303,52 +841,251 @@ class Database(object):
         where: SqlRowDict | None = None,
         need: list[str] | None = None
     ):
-        async with self:
-            return await self.select_nolock(table, where, need)
+        if self._reader_pool is None:
+            async with self:
+                return await self.select_nolock(table, where, need)
+        command, parse_args = self._get_select_command(table, where, need)
+        _LOGGER.debug("execute command %s with args: %s", command, parse_args)
+        async with self.reader() as conn:
+            if where and _LOGGER.isEnabledFor(logging.DEBUG):
+                await self._explain_query_plan(conn, command, parse_args)
+            try:
+                async with conn.execute(command, parse_args) as cursor:
+                    return await cursor.fetchall()
+            except Exception:
+                _LOGGER.error("Error occurred when executing command %s with args: %s", command, parse_args)
+                raise
 
-    async def insert(self, table: str, data_dicts: list[SqlRowDict] | SqlRowDict):
+    async def iter_select(
+        self,
+        table: str,
+        where: SqlRowDict | None = None,
+        need: list[str] | None = None,
+        batch_size: int = SELECT_ITER_BATCH_SIZE,
+        as_tuple: bool = False,
+    ) -> AsyncIterator[Any]:
+        """
+        iterate over the selected rows, fetching `batch_size` rows at a time, so that large tables
+        are scanned in constant memory. rows are `aiosqlite.Row`, or plain tuples if `as_tuple` is True.
+
+        In pooled mode a reader is borrowed for the whole iteration, otherwise the lock is held,
+        so do not write to the database while iterating. If the loop may stop early, wrap the
+        iterator in `contextlib.aclosing` to release them at once.
+        """
+        command, parse_args = self._get_select_command(table, where, need)
+        _LOGGER.debug("iterate command %s with args: %s", command, parse_args)
+        pool = self._reader_pool
+        if pool is not None:
+            conn = await pool.get()
+        else:
+            await self.__aenter__()
+            conn = self.get_cur_connection()
+            self.last_command_and_args = (command, parse_args)
+        error: Exception | None = None
+        try:
+            cursor = await conn.cursor()
+            try:
+                if as_tuple:
+                    cursor.row_factory = None
+                await cursor.execute(command, parse_args)
+                while rows := await cursor.fetchmany(batch_size):
+                    for row in rows:
+                        yield row
+            finally:
+                await cursor.close()
+        except Exception as e:
+            error = e
+            if pool is not None:
+                _LOGGER.error("Error occurred when executing command %s with args: %s", command, parse_args)
+            raise
+        finally:
+            if pool is not None:
+                pool.put_nowait(conn)
+            else:
+                await self.__aexit__(None if error is None else type(error), error, None)
+
+    async def insert(self, table: str, data_dicts: list[SqlRowDict] | SqlRowDict, durable: bool = False):
         async with self:
             await self.insert_nolock(table, data_dicts)
+        if durable:
+            await self.wait_durable()
+
+    async def insert_many(
+        self,
+        table: str,
+        rows: Iterable[SqlRowDict] | AsyncIterable[SqlRowDict],
+        chunk_size: int = BULK_INSERT_CHUNK_SIZE,
+        durable: bool = False,
+    ) -> int:
+        async with self:
+            count = await self.insert_many_nolock(table, rows, chunk_size)
+        if durable:
+            await self.wait_durable()
+        return count
 
-    async def update(self, table: str, datadict: SqlRowDict, where: SqlRowDict | Literal['*'] | None = None):
+    async def update(self, table: str, datadict: SqlRowDict, where: SqlRowDict | Literal['*'] | None = None, durable: bool = False):
         async with self:
             await self.update_nolock(table, datadict, where)
+        if durable:
+            await self.wait_durable()
 
-    async def delete(self, table, where: SqlRowDict | Literal['*']):
+    async def delete(self, table, where: SqlRowDict | Literal['*'], durable: bool = False):
         async with self:
             await self.delete_nolock(table, where)
+        if durable:
+            await self.wait_durable()
 
-    async def execute(self, cmd: list[str], need_commit: bool = True):
+    async def execute(self, cmd: list[str], need_commit: bool = True, durable: bool = False):
         """execute a list of commands."""
         async with self:
             for c in cmd:
                 await self.cursor.execute(c)
             # await self.get_cur_connection().commit()
             self.dirty_mark = need_commit
+            self._invalidate_all_rows()
+        if durable:
+            await self.wait_durable()
+
+    async def run_batch(self, fn: Callable[..., _T], *args: Any, readonly: bool = False, durable: bool = False) -> _T:
+        """
+        run `fn(conn, *args)` on the connection thread in one hop, where `conn` is the `sqlite3.Connection`,
+        and return its result. `fn` must be synchronous and must not commit or rollback.
+
+        The writes of `fn` are atomic: they are made inside a savepoint, which is rolled back if `fn` raises.
+        They are committed like any other write (at once, or by the group commit in write-behind mode).
+        With `readonly=True`, `fn` must not write and runs through `run_read` instead.
+        """
+        if readonly:
+            return await self.run_read(fn, *args)
+        async with self:
+            aconn = self.get_cur_connection()
+            result, in_transaction = await call_on_thread(aconn, self._run_batch_on_thread, fn, args, self.write_behind is not None)
+            # without write-behind, the savepoint commits by itself if no transaction was open before
+            self.dirty_mark = in_transaction
+            if not in_transaction:
+                self._commit_gen += 1
+            self._invalidate_all_rows()
+        if durable:
+            await self.wait_durable()
+        return result
+
+    async def run_read(self, fn: Callable[..., _T], *args: Any) -> _T:
+        """
+        run the read-only `fn(conn, *args)` in one hop, on a reader in pooled mode, else on the connection with the lock.
+        """
+        if self._reader_pool is not None:
+            async with self.reader() as reader:
+                return await call_on_thread(reader, fn, *args)
+        async with self:
+            aconn = self.get_cur_connection()
+            return await call_on_thread(aconn, fn, *args)
+
+    @staticmethod
+    def _run_batch_on_thread(conn: sqlite3.Connection, fn: Callable[..., _T], args: tuple, begin: bool) -> tuple[_T, bool]:
+        began = begin and not conn.in_transaction
+        if began:
+            # so that releasing the savepoint does not commit, the writes wait for the group commit
+            conn.execute("BEGIN;")
+        conn.execute(f"SAVEPOINT {BATCH_SAVEPOINT};")
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {BATCH_SAVEPOINT};")
+            conn.execute(f"RELEASE {BATCH_SAVEPOINT};")
+            if began:
+                conn.execute("ROLLBACK;")
+            raise
+        conn.execute(f"RELEASE {BATCH_SAVEPOINT};")
+        return result, conn.in_transaction
+
+    async def wait_durable(self) -> None:
+        """
+        wait until the pending writes are committed. return at once if nothing is pending.
+        """
+        if self._pending_writes == 0:
+            return
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._commit_waiters.append(future)
+        await future
+
+    async def flush(self) -> None:
+        """
+        commit the pending writes of write-behind mode now.
+        """
+        if self._pending_writes == 0:
+            return
+        async with self.lock:
+            await self._commit_pending()
+
+    async def _delayed_flush(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        # cancelling the task from here on must not drop the commit, or its waiters would never wake up
+        await asyncio.shield(self.flush())
+
+    async def _commit_pending(self) -> None:
+        """
+        commit and wake up the waiters. the lock must be held.
+        """
+        waiters = self._commit_waiters
+        self._commit_waiters = []
+        count = self._pending_writes
+        self._pending_writes = 0
+        try:
+            await self.get_cur_connection().commit()
+        except asyncio.CancelledError:
+            # the commit may still run on the connection thread. commit again later, which wakes up the waiters
+            self._commit_waiters[:0] = waiters
+            self._pending_writes += count
+            if self._flush_task is None and self.write_behind is not None:
+                self._flush_task = asyncio.create_task(self._delayed_flush(self.write_behind))
+            raise
+        except Exception as e:
+            self._invalidate_all_rows()
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            from antares_bot.utils import exception_manual_handle
+            await exception_manual_handle(_LOGGER, e)
+            return
+        self._commit_gen += 1
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        _LOGGER.debug("group commit of %d writes", count)
 
     async def __aenter__(self):
         if self.conn is None:
             raise RuntimeError("Database not connected")
         await self.lock.acquire()
         self._cursor = await self.get_cur_connection().cursor()
-        self._last_command_and_args = None
+        self.last_command_and_args = None
         return True
 
     async def __aexit__(self, exception_type, exception_value, exception_traceback: Optional["TracebackType"]):
         if exception_type is not None:
-            if self._last_command_and_args is not None:
-                last_command, last_args = self._last_command_and_args
+            if self.last_command_and_args is not None:
+                last_command, last_args = self.last_command_and_args
                 _LOGGER.error("Error occurred when executing command %s with args: %s", last_command, last_args)
-        if self.dirty_mark:
+        if self.dirty_mark and self.write_behind is not None:
+            self._pending_writes += 1
+            if self._pending_writes >= self.write_behind_batch:
+                await self._commit_pending()
+            elif self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._delayed_flush(self.write_behind))
+            self.dirty_mark = False
+        elif self.dirty_mark:
             try:
                 await self.get_cur_connection().commit()
             except Exception as e:
+                self._invalidate_all_rows()
                 from antares_bot.utils import exception_manual_handle
                 await exception_manual_handle(_LOGGER, e)
+            self._commit_gen += 1
             self.dirty_mark = False
         self._cursor = None
         self.lock.release()
-        self._last_command_and_args = None
+        self.last_command_and_args = None
         return False
 
     def __getitem__(self, table: str) -> TableProxy:
@@ -0,0 +1,137 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from queue import SimpleQueue
+from typing import Any, Callable, Optional, TypeVar
+
+import aiosqlite
+from aiosqlite.core import set_exception, set_result
+
+from antares_bot.bot_logging import get_logger
+
+
+_LOGGER = get_logger(__name__)
+_T = TypeVar("_T")
+
+
+async def call_on_thread(conn: aiosqlite.Connection, fn: Callable[..., _T], *args: Any) -> _T:
+    """
+    run `fn(sqlite3_conn, *args)` on the thread of `conn`, in one hop.
+    aiosqlite has no public api for this, so like `SharedConnection` it relies on the internals of aiosqlite 0.22.1.
+    """
+    # pylint: disable=protected-access
+    return await conn._execute(fn, conn._conn, *args)
+
+
+class _SqliteWorker:
+    """
+    A thread running the calls of the connections assigned to it, in the order they are queued.
+    Quacks like the queue of `aiosqlite.Connection`.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._queue: SimpleQueue[Optional[tuple[float, Optional[asyncio.Future], Callable[[], Any]]]] = SimpleQueue()
+        self.connections = 0
+        self.tasks = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put_nowait(self, item: tuple[Optional[asyncio.Future], Callable[[], Any]]) -> None:
+        self._queue.put_nowait((time.monotonic(), item[0], item[1]))
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self) -> None:
+        self._queue.put_nowait(None)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            enqueued, future, function = item
+            latency = time.monotonic() - enqueued
+            self.tasks += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+            try:
+                result = function()
+                if future:
+                    future.get_loop().call_soon_threadsafe(set_result, future, result)
+            except BaseException as e:  # noqa: B036
+                if future:
+                    future.get_loop().call_soon_threadsafe(set_exception, future, e)
+
+
+class SharedConnection(aiosqlite.Connection):
+    """
+    An `aiosqlite.Connection` whose calls run on a `_SqliteWorker` shared with other connections,
+    instead of on a thread of its own.
+    Relies on the internals of aiosqlite 0.22.1 (the `_tx` queue, `__await__` starting the thread,
+    `stop`, which 0.22.0 does not have yet), which is why aiosqlite is pinned to `>=0.22.1,<0.23`.
+    """
+
+    def __init__(self, connector: Callable[[], sqlite3.Connection], iter_chunk_size: int, worker: _SqliteWorker) -> None:
+        super().__init__(connector, iter_chunk_size)
+        self._tx = worker  # type: ignore[assignment]
+        self._worker: Optional[_SqliteWorker] = worker
+        worker.connections += 1
+
+    def __await__(self):
+        # no thread to start
+        return self._connect().__await__()
+
+    def stop(self) -> Optional[asyncio.Future]:
+        future = super().stop()
+        if self._worker is not None:
+            self._worker.connections -= 1
+            self._worker = None
+        return future
+
+
+class SqliteWorkerPool:
+    """
+    A fixed number of threads shared by many sqlite connections. Each connection is pinned to
+    the worker with the fewest connections, so its calls keep their order.
+    A long statement delays the other connections of its worker, see `stats` for the queue latency.
+    """
+
+    def __init__(self, threads: int) -> None:
+        if threads < 1:
+            raise ValueError("at least one worker thread is needed")
+        self._workers = [_SqliteWorker(f"sqlite-worker-{i}") for i in range(threads)]
+
+    def connect(self, database: str, *, iter_chunk_size: int = 64, **kwargs: Any) -> SharedConnection:
+        """
+        same as `aiosqlite.connect`.
+        """
+        def connector() -> sqlite3.Connection:
+            return sqlite3.connect(database, **kwargs)
+
+        worker = min(self._workers, key=lambda w: w.connections)
+        return SharedConnection(connector, iter_chunk_size, worker)
+
+    def stats(self) -> dict[str, Any]:
+        tasks = sum(w.tasks for w in self._workers)
+        total_latency = sum(w.total_latency for w in self._workers)
+        return {
+            "threads": len(self._workers),
+            "connections": sum(w.connections for w in self._workers),
+            "queued": sum(w.qsize() for w in self._workers),
+            "tasks": tasks,
+            "avg_queue_latency_ms": total_latency / tasks * 1000 if tasks else 0.,
+            "max_queue_latency_ms": max(w.max_latency for w in self._workers) * 1000,
+        }
+
+    def shutdown(self) -> None:
+        """
+        stop the workers once the calls already queued are done. close the connections first.
+        """
+        for worker in self._workers:
+            worker.stop()
+        _LOGGER.info("Stopped %d sqlite worker threads", len(self._workers))
@@ -0,0 +1,25 @@
+import sys
+import types
+
+
+def _install_bot_cfg() -> None:
+    """
+    antares_bot reads its config from a `bot_cfg` module of the working directory, and exits if there is none.
+    """
+    if "bot_cfg" in sys.modules:
+        return
+    bot_cfg = types.ModuleType("bot_cfg")
+
+    class BasicConfig:
+        TOKEN = "123456:test-token"
+        MASTER_ID = 1
+
+    class AntaresBotConfig:
+        SKIP_PIKA_SETUP = True
+
+    bot_cfg.BasicConfig = BasicConfig  # type: ignore[attr-defined]
+    bot_cfg.AntaresBotConfig = AntaresBotConfig  # type: ignore[attr-defined]
+    sys.modules["bot_cfg"] = bot_cfg
+
+
+_install_bot_cfg()
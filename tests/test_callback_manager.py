@@ -0,0 +1,66 @@
+from antares_bot.callback_manager import CallbackDataManager, PersistKeyboards
+from antares_bot.sqlite.callback_store import CallbackDataStore
+
+
+def test_keyboard_keeps_identity_while_running(tmp_path) -> None:
+    manager = CallbackDataManager(max_size=2, store=CallbackDataStore(str(tmp_path / "cb.db")))
+    keyboard: PersistKeyboards[str] = PersistKeyboards(manager, single_entry=True)
+    keyboard.setup_use_data(["a", "b", "c"])
+    key = keyboard.cb_data_keys[1]
+    for i in range(10):
+        manager.set_data(("other", i))  # spills the other entries, not the keyboard
+    assert manager.stats()["spilled"] > 0
+    keyboard.modify_data_by_index(1, "B")
+    data, found = manager.peek_data(key)
+    assert found is keyboard
+    assert data == "B"
+    assert keyboard.idx(key) == 1
+    manager.close()
+
+
+def test_keyboard_round_trip_through_close(tmp_path) -> None:
+    path = str(tmp_path / "cb.db")
+    manager = CallbackDataManager(max_size=2, store=CallbackDataStore(path))
+    keyboard: PersistKeyboards[str] = PersistKeyboards(manager, single_entry=True)
+    keyboard.setup_use_data(["a", "b", "c"], repr_cb=lambda idx, key, data: data)
+    keyboard.modify_data_by_index(2, "C")
+    keys = list(keyboard.cb_data_keys)
+    manager.close()
+
+    manager = CallbackDataManager(max_size=2, store=CallbackDataStore(path))
+    data, loaded = manager.peek_data(keys[2])
+    assert data == "C"
+    # a new object after a restart, attached to the new manager, without repr_cb
+    assert loaded is not keyboard
+    assert loaded.cb_manager is manager
+    assert loaded.repr_cb is None
+    assert [loaded.get_data_by_index(i) for i in range(3)] == ["a", "b", "C"]
+    assert manager.pop_data(keys[0]) == ("a", loaded)
+    assert manager.peek_data(keys[0]) is None
+    manager.close()
+
+
+def test_modify_data_ignores_missing_keys(tmp_path) -> None:
+    for store in (None, CallbackDataStore(str(tmp_path / "cb.db"))):
+        manager = CallbackDataManager(max_size=4, ttl=60, store=store)
+        popped = manager.set_data("popped")
+        kept = manager.set_data("kept")
+        manager.pop_data(popped)
+        manager.modify_data(popped, "again")
+        manager.modify_data(kept, "changed")
+        assert manager.peek_data(popped) is None
+        assert manager.peek_data(kept) == "changed"
+        assert manager.stats()["size"] == 1
+        manager.close()
+
+
+def test_modify_data_of_expired_key_does_not_leak(monkeypatch) -> None:
+    now = [1000.]
+    monkeypatch.setattr("antares_bot.callback_manager.time.time", lambda: now[0])
+    manager = CallbackDataManager(ttl=10)
+    key = manager.set_data("old")
+    now[0] += 20
+    manager.sweep()
+    manager.modify_data(key, "new")
+    assert manager.peek_data(key) is None
+    assert manager.stats()["size"] == 0
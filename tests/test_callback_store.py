@@ -0,0 +1,32 @@
+import pickle
+
+from antares_bot.callback_manager import CallbackDataManager
+from antares_bot.sqlite.callback_store import CallbackDataStore
+
+
+class _Removed:
+    pass
+
+
+def test_unloadable_value_is_dropped(tmp_path) -> None:
+    store = CallbackDataStore(str(tmp_path / "callback_data.db"))
+    assert store.put(1, _Removed())
+    # as if the class was removed by a deploy
+    blob = pickle.dumps(_Removed()).replace(b"_Removed", b"_Missing")
+    store.conn.execute("UPDATE callback_data SET data=? WHERE id=1;", (blob,))  # type: ignore[union-attr]
+    assert store.get(1) == (False, None)
+    assert store.count() == 0
+    store.close()
+
+
+def test_manager_treats_unloadable_entry_as_missing(tmp_path) -> None:
+    path = str(tmp_path / "callback_data.db")
+    store = CallbackDataStore(path)
+    manager = CallbackDataManager(max_size=1, store=store)
+    key = manager.set_data(("a", 1))
+    manager.set_data(("b", 2))  # spills the first entry
+    blob = pickle.dumps(_Removed()).replace(b"_Removed", b"_Missing")
+    store.conn.execute("UPDATE callback_data SET data=?;", (blob,))  # type: ignore[union-attr]
+    assert manager.peek_data(key) is None
+    assert manager.pop_data(key) is None
+    manager.close()
@@ -0,0 +1,64 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from antares_bot.sqlite.creater import INT, TEXT, DbDeclarer
+
+
+def _declare(path: str, **name_options) -> DbDeclarer:
+    db = DbDeclarer().declare(path)
+    db.declare_table("t").declare_col("id", INT, is_primary=True).declare_col("name", TEXT, **name_options)
+    return db
+
+
+def test_unique_and_default_changes_rebuild_the_table(tmp_path) -> None:
+    path = str(tmp_path / "t.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INT PRIMARY KEY, name TEXT DEFAULT 'a', note TEXT)")
+    conn.execute("CREATE INDEX idx_custom ON t (note)")
+    conn.execute("CREATE TABLE log (id INT)")
+    conn.execute("CREATE TRIGGER t_insert AFTER INSERT ON t BEGIN INSERT INTO log VALUES (new.id); END")
+    conn.execute("INSERT INTO t (id, name) VALUES (1, 'x')")
+    conn.commit()
+    conn.close()
+
+    asyncio.run(_declare(path, is_unique=True, default="b").validate())
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT id, name FROM t").fetchall() == [(1, "x")]
+    assert conn.execute("SELECT dflt_value FROM pragma_table_info('t') WHERE name = 'name'").fetchone() == ("'b'",)
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO t (id, name) VALUES (2, 'x')")
+    # the undeclared index and the trigger survive the rebuild
+    assert {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL")} == {
+        "idx_custom", "t_insert",
+    }
+    conn.execute("INSERT INTO t (id) VALUES (3)")
+    assert conn.execute("SELECT name FROM t WHERE id = 3").fetchone() == ("b",)
+    # the copy did not fire the trigger
+    assert conn.execute("SELECT id FROM log").fetchall() == [(1,), (3,)]
+    conn.close()
+
+    # dropping the constraint is a change too
+    asyncio.run(_declare(path).validate())
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO t (id, name) VALUES (4, 'x')")
+    assert conn.execute("SELECT dflt_value FROM pragma_table_info('t') WHERE name = 'name'").fetchone() == (None,)
+    conn.close()
+
+
+def test_matching_table_is_not_rebuilt(tmp_path) -> None:
+    path = str(tmp_path / "t.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INT PRIMARY KEY, name TEXT UNIQUE DEFAULT 'b')")
+    conn.commit()
+    version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    conn.close()
+
+    asyncio.run(_declare(path, is_unique=True, default="b").validate())
+
+    conn = sqlite3.connect(path)
+    # only the fingerprint table was created
+    assert conn.execute("PRAGMA schema_version").fetchone()[0] == version + 1
+    conn.close()
@@ -0,0 +1,96 @@
+import datetime
+from typing import Any, List, Optional
+
+from telegram import CallbackQuery, Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application, ApplicationBuilder, BaseHandler, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters
+
+from antares_bot.patching.dispatch_handler import CallbackQueryDispatchHandler, CommandDispatchHandler, add_handler
+
+
+TOKEN = "123456:test-token"
+
+
+class _FakeBot:
+    username = "test_bot"
+
+
+async def _callback(update: object, context: Any) -> None:
+    ...
+
+
+def _command_update(text: str) -> Update:
+    message = Message(
+        1, datetime.datetime.now(), Chat(1, Chat.PRIVATE), text=text,
+        entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))],
+    )
+    message.set_bot(_FakeBot())  # type: ignore[arg-type]
+    return Update(1, message=message)
+
+
+def _callback_query_update(data: str) -> Update:
+    return Update(1, callback_query=CallbackQuery("1", User(1, "user", False), "chat", data=data))
+
+
+def _dispatch(application: Application, update: Update) -> Optional[BaseHandler]:
+    """
+    the handler the application runs for `update`, checking the default group in order as PTB does.
+    """
+    for handler in application.handlers.get(0, []):
+        check = handler.check_update(update)
+        if check is None or check is False:
+            continue
+        if isinstance(handler, (CommandDispatchHandler, CallbackQueryDispatchHandler)):
+            return check[0]
+        return handler
+    return None
+
+
+def _applications(handlers: List[BaseHandler]) -> tuple[Application, Application]:
+    """
+    an application with the handlers added as plain PTB does, and one with `add_handler`.
+    """
+    plain = ApplicationBuilder().token(TOKEN).build()
+    indexed = ApplicationBuilder().token(TOKEN).build()
+    for handler in handlers:
+        plain.add_handler(handler)
+        add_handler(indexed, handler)
+    return plain, indexed
+
+
+def test_command_dispatch_keeps_the_order_of_handlers() -> None:
+    handlers: List[BaseHandler] = [
+        CommandHandler("a", _callback),
+        MessageHandler(filters.Regex("^/b"), _callback),
+        CommandHandler("b", _callback),
+        CommandHandler("a", _callback),
+        CommandHandler("c", _callback, filters=filters.Regex("only")),
+        CommandHandler("c", _callback),
+    ]
+    plain, indexed = _applications(handlers)
+    # a dispatcher per run of command handlers
+    assert [type(handler) for handler in indexed.handlers[0]] == [CommandDispatchHandler, MessageHandler, CommandDispatchHandler]
+    for text in ("/a", "/b", "/b@test_bot", "/b@other_bot", "/c", "/c only", "/d", "/A"):
+        update = _command_update(text)
+        assert _dispatch(indexed, update) is _dispatch(plain, update), text
+    assert _dispatch(indexed, _command_update("/b")) is handlers[1]
+    assert _dispatch(indexed, _command_update("/c only")) is handlers[4]
+
+
+def test_callback_query_dispatch_keeps_the_order_of_handlers() -> None:
+    handlers: List[BaseHandler] = [
+        CallbackQueryHandler(_callback, pattern="^ab"),
+        CallbackQueryHandler(_callback, pattern="^abc"),
+        CallbackQueryHandler(_callback, pattern="^x.*y"),
+        CallbackQueryHandler(_callback, pattern="^xy"),
+        TypeHandler(Update, _callback),
+        CallbackQueryHandler(_callback, pattern="^late"),
+    ]
+    plain, indexed = _applications(handlers)
+    assert [type(handler) for handler in indexed.handlers[0]] == [CallbackQueryDispatchHandler, TypeHandler, CallbackQueryDispatchHandler]
+    for data in ("ab:1", "abc:1", "abcd", "xzy:1", "xy:1", "xy", "late:1", "zzz", ""):
+        update = _callback_query_update(data)
+        assert _dispatch(indexed, update) is _dispatch(plain, update), data
+    # an earlier prefix or regex pattern wins over an exact key
+    assert _dispatch(indexed, _callback_query_update("abc:1")) is handlers[0]
+    assert _dispatch(indexed, _callback_query_update("xy:1")) is handlers[2]
+    assert _dispatch(indexed, _callback_query_update("late:1")) is handlers[4]
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram import CallbackQuery, User
+
+from antares_bot.callback_manager import CallbackDataManager
+from antares_bot.callback_payload import SignedCallbackCodec
+from antares_bot.module_base import TelegramBotModuleBase
+
+
+class _Module(TelegramBotModuleBase):
+    ...
+
+
+def _module() -> _Module:
+    parent = SimpleNamespace(callback_codec=SignedCallbackCodec(b"secret"), callback_manager=CallbackDataManager())
+    return _Module(parent)  # type: ignore[arg-type]
+
+
+def _query(data: str) -> CallbackQuery:
+    return CallbackQuery("1", User(1, "user", False), "chat", data=data)
+
+
+def test_signed_callback_round_trip() -> None:
+    module = _module()
+    data = module.make_btn_signed_callback("pick", [1, ("a", None)])
+    assert [module.get_btn_callback_data(_query(dt)) for dt in data] == [1, ("a", None)]
+    # signed for another key
+    assert module.get_btn_callback_data(_query("other:" + data[0].partition(":")[2])) is None
+
+
+def test_signed_callback_key_must_not_contain_colon() -> None:
+    with pytest.raises(ValueError):
+        _module().make_btn_signed_callback("pick:one", [1])
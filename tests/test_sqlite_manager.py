@@ -0,0 +1,159 @@
+import asyncio
+import sqlite3
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+from antares_bot.sqlite.manager import Database
+
+
+def _run(tmp_path, check: Callable[[Database], Awaitable[None]], **kwargs: Any) -> None:
+    """
+    run `check` on a connected database with a table `t (id, name)`.
+    """
+    path = str(tmp_path / "t.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INT PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+
+    async def run() -> None:
+        db = Database(path, **kwargs)
+        await db.connect()
+        try:
+            await check(db)
+        finally:
+            # an open connection would keep its thread, and the test process, alive
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_row_cache_skips_reads_with_pending_writes(tmp_path) -> None:
+    async def check(db: Database) -> None:
+        db["t"].enable_row_cache(8)
+        await db.insert("t", {"id": 1, "name": "a"})
+        assert db.has_pending_writes
+        assert await db["t"].aget(1) == {"id": 1, "name": "a"}
+        assert db["t"].row_cache_stats()["size"] == 0
+        gen = db.commit_gen
+        await db.flush()
+        assert not db.has_pending_writes
+        assert db.commit_gen == gen + 1
+        assert await db["t"].aget(1) == {"id": 1, "name": "a"}
+        assert db["t"].row_cache_stats()["size"] == 1
+        # the setting survives a reload of the table info
+        await db.update_table_info()
+        assert db["t"].row_cache_size == 8
+
+    _run(tmp_path, check, write_behind=60)
+
+
+def test_aget_many_reuses_cached_statements(tmp_path) -> None:
+    async def check(db: Database) -> None:
+        await db.insert_many("t", ({"id": i, "name": str(i)} for i in range(10)))
+        assert len(await db["t"].aget_many([1, 2, 42])) == 2
+        misses = db.statement_cache_stats()["misses"]
+        async with db:
+            rows = await db["t"].aget_many_nolock([4, 5, 6])
+            assert db.last_command_and_args is not None
+            assert db.last_command_and_args[1] == [4, 5, 6]
+        assert db.last_command_and_args is None
+        assert sorted(rows) == [4, 5, 6]
+        assert db.statement_cache_stats()["misses"] == misses
+
+    _run(tmp_path, check)
+
+
+def test_close_during_group_commit_wakes_up_waiters(tmp_path) -> None:
+    async def check(db: Database) -> None:
+        conn = db.get_cur_connection()
+        commit = conn.commit
+        committing = asyncio.Event()
+
+        async def slow_commit() -> None:
+            committing.set()
+            await asyncio.sleep(0.1)
+            await commit()
+
+        conn.commit = slow_commit  # type: ignore[method-assign]
+        await db.insert("t", {"id": 1, "name": "a"})
+        waiter = asyncio.ensure_future(db.wait_durable())
+        await asyncio.wait_for(committing.wait(), 1)
+        await db.close()
+        await asyncio.wait_for(waiter, 1)
+        assert not db.has_pending_writes
+
+    _run(tmp_path, check, write_behind=0.01)
+    conn = sqlite3.connect(str(tmp_path / "t.db"))
+    assert conn.execute("SELECT name FROM t WHERE id = 1").fetchone() == ("a",)
+    conn.close()
+
+
+def test_cancelled_commit_is_retried(tmp_path) -> None:
+    async def check(db: Database) -> None:
+        conn = db.get_cur_connection()
+        commit = conn.commit
+        calls = 0
+
+        async def cancelled_once() -> None:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise asyncio.CancelledError
+            await commit()
+
+        conn.commit = cancelled_once  # type: ignore[method-assign]
+        await db.insert("t", {"id": 1, "name": "a"})
+        waiter = asyncio.ensure_future(db.wait_durable())
+        try:
+            await db.flush()
+        except asyncio.CancelledError:
+            pass
+        assert db.has_pending_writes
+        await asyncio.wait_for(waiter, 1)
+        assert calls == 2
+
+    _run(tmp_path, check, write_behind=0.01)
+
+
+def test_insert_many_ends_the_transaction_it_opened(tmp_path) -> None:
+    async def check(db: Database) -> None:
+        conn = db.get_cur_connection()
+        assert await db.insert_many("t", []) == 0
+        assert not conn.in_transaction
+        try:
+            await db.insert_many("t", [{"id": 1, "name": "a"}, {"id": 2, "wrong": "b"}])
+        except ValueError:
+            pass
+        assert not conn.in_transaction
+        assert await db.insert_many("t", iter([{"id": 3, "name": "c"}])) == 1
+        assert not conn.in_transaction
+        assert [row["id"] for row in await db.select("t")] == [3]
+
+    _run(tmp_path, check)
+
+
+def test_run_batch_waits_for_the_group_commit(tmp_path) -> None:
+    def write(conn: sqlite3.Connection, row_id: int) -> int:
+        conn.execute("INSERT INTO t (id, name) VALUES (?, 'a')", (row_id,))
+        return row_id
+
+    def fail(conn: sqlite3.Connection) -> None:
+        conn.execute("INSERT INTO t (id, name) VALUES (2, 'b')")
+        raise ValueError
+
+    async def check(db: Database) -> None:
+        assert await db.run_batch(write, 1) == 1
+        assert db.has_pending_writes
+        assert db.get_cur_connection().in_transaction
+        await db.flush()
+        with pytest.raises(ValueError):
+            await db.run_batch(fail)
+        assert not db.get_cur_connection().in_transaction
+        assert await db.run_batch(write, 3) == 3
+        await db.flush()
+        assert not db.get_cur_connection().in_transaction
+        assert [row["id"] for row in await db.select("t")] == [1, 3]
+
+    _run(tmp_path, check, write_behind=60)
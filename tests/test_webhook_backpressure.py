@@ -0,0 +1,151 @@
+import asyncio
+import json
+import socket
+
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from antares_bot.patching.update_queue_ex import BoundedUpdateQueue
+
+
+# the webhook server of PTB needs the `webhook` extra
+tornado = pytest.importorskip("tornado")
+import tornado.httpclient  # noqa: E402
+import tornado.web  # noqa: E402
+
+
+TOKEN = "123456:test-token"
+WORKERS = 2
+QUEUE_SIZE = 2
+UPDATES = 6
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _FakeBotApi(tornado.web.RequestHandler):
+    """
+    local stand-in of the Bot API, enough for `initialize` and `start_webhook`.
+    """
+
+    def post(self, method: str) -> None:
+        if method == "getMe":
+            result: object = {"id": 123456, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        else:
+            result = True
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+
+def _update_json(update_id: int) -> bytes:
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "text": "hi",
+        },
+    }).encode()
+
+
+async def _run() -> None:
+    api_port = _free_port()
+    api = tornado.web.Application([(rf"/bot{TOKEN}/(\w+)", _FakeBotApi)]).listen(api_port, address="127.0.0.1")
+    queue = BoundedUpdateQueue(maxsize=QUEUE_SIZE, max_in_flight=WORKERS)
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .base_url(f"http://127.0.0.1:{api_port}/bot")
+        .update_queue(queue)
+        .concurrent_updates(WORKERS)
+        .build()
+    )
+    release = asyncio.Event()
+    running = 0
+    max_running = 0
+    handled = 0
+
+    async def slow_handler(update: object, context: object) -> None:
+        nonlocal running, max_running, handled
+        running += 1
+        max_running = max(max_running, running)
+        await release.wait()
+        running -= 1
+        handled += 1
+
+    app.add_handler(TypeHandler(Update, slow_handler))
+    webhook_port = _free_port()
+    await app.initialize()
+    await app.start()
+    assert app.updater is not None
+    await app.updater.start_webhook(
+        listen="127.0.0.1",
+        port=webhook_port,
+        url_path="hook",
+        webhook_url=f"http://127.0.0.1:{webhook_port}/hook",
+    )
+    client = tornado.httpclient.AsyncHTTPClient()
+    try:
+        posts = [
+            asyncio.ensure_future(client.fetch(
+                f"http://127.0.0.1:{webhook_port}/hook",
+                method="POST",
+                body=_update_json(i),
+                headers={"Content-Type": "application/json"},
+                request_timeout=10,
+            ))
+            for i in range(UPDATES)
+        ]
+        for _ in range(50):
+            await asyncio.sleep(0.02)
+            if running == WORKERS and queue.qsize() == QUEUE_SIZE:
+                break
+        # the workers are busy and the queue is full: the remaining posts wait for room
+        await asyncio.sleep(0.1)
+        assert running == WORKERS
+        assert queue.qsize() == QUEUE_SIZE
+        assert queue.in_flight == WORKERS
+        assert sum(not post.done() for post in posts) == UPDATES - WORKERS - QUEUE_SIZE
+
+        release.set()
+        responses = await asyncio.gather(*posts)
+        assert all(response.code == 200 for response in responses)
+        for _ in range(50):
+            if handled == UPDATES:
+                break
+            await asyncio.sleep(0.02)
+        assert handled == UPDATES
+        assert max_running == WORKERS
+        assert queue.in_flight == 0
+    finally:
+        release.set()
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        api.stop()
+
+
+def test_webhook_waits_for_a_free_worker() -> None:
+    asyncio.run(_run())
+
+
+def test_bounded_queue_releases_slots_on_task_done() -> None:
+    async def run() -> None:
+        queue = BoundedUpdateQueue(max_in_flight=1)
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        assert await queue.get() == 1
+        second = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        queue.task_done()
+        assert await asyncio.wait_for(second, 1) == 2
+        queue.task_done()
+        assert queue.in_flight == 0
+
+    asyncio.run(run())
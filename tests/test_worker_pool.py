@@ -0,0 +1,99 @@
+import asyncio
+import sqlite3
+import threading
+
+import aiosqlite
+import pytest
+
+from antares_bot.sqlite.manager import Database, DataBasesManager
+from antares_bot.sqlite.worker_pool import SqliteWorkerPool, call_on_thread
+
+
+def _thread_and_sum(conn: sqlite3.Connection, a: int, b: int) -> tuple[int, int]:
+    return threading.get_ident(), conn.execute("SELECT ? + ?", (a, b)).fetchone()[0]
+
+
+def _fail(conn: sqlite3.Connection) -> None:
+    conn.execute("SELECT * FROM missing_table")
+
+
+def test_call_on_thread() -> None:
+    async def run() -> None:
+        pool = SqliteWorkerPool(1)
+        for conn in (aiosqlite.connect(":memory:"), pool.connect(":memory:")):
+            await conn
+            try:
+                thread, total = await call_on_thread(conn, _thread_and_sum, 1, 2)
+                assert total == 3
+                assert thread != threading.get_ident()
+                with pytest.raises(sqlite3.OperationalError):
+                    await call_on_thread(conn, _fail)
+            finally:
+                await conn.close()
+        pool.shutdown()
+
+    asyncio.run(run())
+
+
+def _worker_threads() -> list[threading.Thread]:
+    return [thread for thread in threading.enumerate() if thread.name.startswith("sqlite-worker-")]
+
+
+def test_shared_connections_round_trip(tmp_path) -> None:
+    async def run() -> None:
+        pool = SqliteWorkerPool(2)
+        conns = [await pool.connect(str(tmp_path / f"{i}.db")) for i in range(3)]
+        assert pool.stats()["connections"] == 3
+        # pinned to the worker with the fewest connections
+        assert sorted(conn._worker.connections for conn in conns) == [1, 2, 2]  # pylint: disable=protected-access
+        for i, conn in enumerate(conns):
+            await conn.execute("CREATE TABLE t (v INT)")
+            # calls of a connection keep their order on the shared thread
+            await asyncio.gather(*(conn.execute("INSERT INTO t VALUES (?)", (v,)) for v in range(50)))
+            await conn.commit()
+            async with conn.execute("SELECT v FROM t ORDER BY rowid") as cursor:
+                assert [row[0] for row in await cursor.fetchall()] == list(range(50))
+            assert (await conn.execute_fetchall("SELECT ?", (i,))) == [(i,)]
+        stats = pool.stats()
+        assert stats["threads"] == 2
+        assert stats["tasks"] > 150
+        assert stats["max_queue_latency_ms"] >= stats["avg_queue_latency_ms"] >= 0
+        for conn in conns:
+            await conn.close()
+        assert pool.stats()["connections"] == 0
+        pool.shutdown()
+
+    asyncio.run(run())
+    for thread in _worker_threads():
+        thread.join(5)
+    assert not _worker_threads()
+
+
+def test_databases_on_shared_workers(tmp_path) -> None:
+    path = str(tmp_path / "t.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INT PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+
+    async def run() -> None:
+        manager = DataBasesManager.get_inst()
+        manager.enable_shared_workers(1)
+        try:
+            db = Database(path, readers=1)
+            await db.connect()
+            await db.insert("t", {"id": 1, "name": "a"})
+            assert await db["t"].aget(1) == {"id": 1, "name": "a"}
+            stats = manager.worker_stats()
+            assert stats is not None
+            # the writer and the reader share the single thread
+            assert stats["threads"] == 1 and stats["connections"] == 2
+        finally:
+            await manager.shutdown()
+        assert db.conn is None
+        assert manager.worker_stats() is None
+
+    asyncio.run(run())
+    for thread in _worker_threads():
+        thread.join(5)
+    assert not _worker_threads()